@@ -3,11 +3,29 @@ import os
 
 sys.path.insert(0, os.path.dirname(__file__))
 from classes import (
+    BatchContext,
+    Coordinator,
+    DataflowBuilder,
+    Event,
+    FusedTask,
+    GraphDefinition,
+    GraphEngines,
+    GraphInliner,
+    GraphReport,
+    GraphRunner,
+    Instrumentation,
+    LatencyCollector,
+    TraceCollector,
+    instrumentation,
     KeyGetter,
     Signature,
     Protocols,
     Context,
+    ScopedContext,
     Task,
+    TaskFuser,
     Workflow,
     WorkflowWithAssumptions,
+    WorkflowGraph,
+    run_worker,
 )
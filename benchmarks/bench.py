@@ -0,0 +1,328 @@
+"""Benchmarks of Task, Context.resolve_keys and WorkflowGraph protocols.
+
+Run from the repository directory:
+
+    python benchmarks/bench.py run --out results.json
+    python benchmarks/bench.py run --shapes chain,random --sizes 10,1000,100000
+    python benchmarks/bench.py compare baseline.json results.json
+"""
+
+import sys
+import os
+
+sys.path.append("..")
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import random
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from grapy.classes import (
+    Context,
+    KeyGetter,
+    Protocols,
+    Signature,
+    Task,
+    WorkflowGraph,
+)
+
+
+def _node(index):
+    return Task(int, Signature(index), f"n{index}")
+
+
+def _edge():
+    return Task(int, Signature(0))
+
+
+def chain_graph(size, protocol=None):
+    """node 0 -> node 1 -> ... -> node size-1"""
+    return WorkflowGraph(
+        nodes={index: _node(index) for index in range(size)},
+        edges={(index, index + 1): _edge() for index in range(size - 1)},
+        root_node=0,
+        protocol=protocol,
+    )
+
+
+def fanout_graph(size, protocol=None):
+    """node 0 -> every other node"""
+    return WorkflowGraph(
+        nodes={index: _node(index) for index in range(size)},
+        edges={(0, index): _edge() for index in range(1, size)},
+        root_node=0,
+        protocol=protocol,
+    )
+
+
+def diamond_graph(size, protocol=None):
+    """node 0 -> size-2 nodes in the middle -> node size-1"""
+    size = max(size, 3)
+    sink = size - 1
+    edges = {}
+    for index in range(1, sink):
+        edges[(0, index)] = _edge()
+        edges[(index, sink)] = _edge()
+    return WorkflowGraph(
+        nodes={index: _node(index) for index in range(size)},
+        edges=edges,
+        root_node=0,
+        protocol=protocol,
+    )
+
+
+def random_graph(size, protocol=None, width=8, degree=2, seed=0):
+    """Random layered DAG: node 0, then layers of width nodes, each node with
+    up to degree parents in the layer before it."""
+    rng = random.Random(seed)
+    edges = {}
+    for index in range(1, size):
+        layer = (index - 1) // width
+        if layer == 0:
+            parents = [0]
+        else:
+            previous = range(1 + (layer - 1) * width, 1 + layer * width)
+            parents = rng.sample(previous, min(degree, len(previous)))
+        for parent in parents:
+            edges[(parent, index)] = _edge()
+    return WorkflowGraph(
+        nodes={index: _node(index) for index in range(size)},
+        edges=edges,
+        root_node=0,
+        protocol=protocol,
+    )
+
+
+SHAPES = {
+    "chain": chain_graph,
+    "fanout": fanout_graph,
+    "diamond": diamond_graph,
+    "random": random_graph,
+}
+
+PROTOCOLS = {
+    "Balanced": lambda: Protocols.WorkflowGraphProtocols.Balanced(),
+    "Parallel": lambda: Protocols.WorkflowGraphProtocols.Parallel(max_workers=4),
+    "Async": lambda: Protocols.WorkflowGraphProtocols.Async(),
+    "CriticalPath": lambda: Protocols.WorkflowGraphProtocols.CriticalPath(
+        max_workers=4
+    ),
+}
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def measure(name, run, items=1, repeat=20, min_time=0.2):
+    """Time run() at least repeat times and for min_time seconds.
+
+    Throughput counts items per second, e.g. graph items per run.
+    """
+    run()  # warm up caches and compiled plans
+    durations = []
+    started = time.perf_counter()
+    while len(durations) < repeat or time.perf_counter() - started < min_time:
+        begin = time.perf_counter_ns()
+        run()
+        durations.append(time.perf_counter_ns() - begin)
+    durations.sort()
+
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    mean = sum(durations) / len(durations) / 1e9
+    return {
+        "name": name,
+        "runs": len(durations),
+        "items": items,
+        "mean_s": mean,
+        "p50_s": _percentile(durations, 0.5) / 1e9,
+        "p90_s": _percentile(durations, 0.9) / 1e9,
+        "p99_s": _percentile(durations, 0.99) / 1e9,
+        "throughput_per_s": items / mean if mean else None,
+        "peak_bytes": peak,
+    }
+
+
+def micro_benchmarks(repeat, min_time):
+    """Per call cost of Task, Context.resolve_keys and Balanced traversal."""
+    context = Context(a=1, b=2)
+    calls = 1000
+    signature = Signature(KeyGetter("a"), 3, z=KeyGetter("b"))
+    frozen = Signature(KeyGetter("a"), 3, z=KeyGetter("b")).freeze()
+    task = Task(lambda x, y, z: x, signature, "out")
+    frozen_task = Task(lambda x, y, z: x, frozen, "out")
+    graph = random_graph(1000, Protocols.WorkflowGraphProtocols.Balanced())
+
+    def many(func):
+        def run():
+            for _ in range(calls):
+                func()
+
+        return run
+
+    return [
+        measure(
+            "micro/resolve_keys",
+            many(lambda: context.resolve_keys(signature)),
+            calls,
+            repeat,
+            min_time,
+        ),
+        measure(
+            "micro/resolve_keys_frozen",
+            many(lambda: context.resolve_keys(frozen)),
+            calls,
+            repeat,
+            min_time,
+        ),
+        measure("micro/task", many(lambda: task(context)), calls, repeat, min_time),
+        measure(
+            "micro/task_frozen",
+            many(lambda: frozen_task(context)),
+            calls,
+            repeat,
+            min_time,
+        ),
+        measure(
+            "micro/traverse_random_1000",
+            lambda: sum(1 for _ in graph.protocol._traverse(graph)),
+            len(graph.nodes) + len(graph.edges),
+            repeat,
+            min_time,
+        ),
+    ]
+
+
+def graph_benchmark(shape, size, protocol_name, repeat, min_time):
+    graph = SHAPES[shape](size, PROTOCOLS[protocol_name]())
+    items = len(graph.nodes) + len(graph.edges)
+    if protocol_name == "Async":
+        loop = asyncio.new_event_loop()
+
+        def run():
+            loop.run_until_complete(graph(Context()))
+
+    else:
+
+        def run():
+            graph(Context())
+
+    try:
+        return measure(
+            f"graph/{protocol_name}/{shape}/{size}", run, items, repeat, min_time
+        )
+    finally:
+        if protocol_name == "Async":
+            loop.close()
+
+
+def run_suite(shapes, sizes, protocols, repeat=20, min_time=0.2, micro=True):
+    results = micro_benchmarks(repeat, min_time) if micro else []
+    for protocol_name in protocols:
+        for shape in shapes:
+            for size in sizes:
+                results.append(
+                    graph_benchmark(shape, size, protocol_name, repeat, min_time)
+                )
+    return {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=0.1, metric="p50_s"):
+    """Return rows (name, baseline, current, ratio, regressed) for the
+    benchmarks present in both result sets."""
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        old = baseline_results.get(result["name"])
+        if old is None or not old[metric]:
+            continue
+        ratio = result[metric] / old[metric]
+        rows.append(
+            (result["name"], old[metric], result[metric], ratio, ratio > 1 + threshold)
+        )
+    return rows
+
+
+def _split(value, convert=str):
+    return [convert(item) for item in value.split(",") if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--shapes", default=",".join(SHAPES))
+    run_parser.add_argument("--sizes", default="10,1000,10000")
+    run_parser.add_argument("--protocols", default=",".join(PROTOCOLS))
+    run_parser.add_argument("--repeat", type=int, default=20)
+    run_parser.add_argument("--min-time", type=float, default=0.2)
+    run_parser.add_argument("--no-micro", action="store_true")
+    run_parser.add_argument("--out", help="write JSON results to this file")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    compare_parser.add_argument("--metric", default="p50_s")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        results = run_suite(
+            _split(args.shapes),
+            _split(args.sizes, int),
+            _split(args.protocols),
+            args.repeat,
+            args.min_time,
+            not args.no_micro,
+        )
+        for result in results["results"]:
+            print(
+                f"{result['name']:<40} p50 {result['p50_s'] * 1e3:10.3f} ms"
+                f"  p99 {result['p99_s'] * 1e3:10.3f} ms"
+                f"  {result['throughput_per_s']:14.0f} items/s"
+                f"  peak {result['peak_bytes'] / 1024:10.1f} KiB"
+            )
+        if args.out:
+            with open(args.out, "w") as file:
+                json.dump(results, file, indent=2)
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    rows = compare(baseline, current, args.threshold, args.metric)
+    for name, old, new, ratio, regressed in rows:
+        flag = "REGRESSION" if regressed else ""
+        print(
+            f"{name:<40} {old * 1e3:10.3f} -> {new * 1e3:10.3f} ms  x{ratio:5.2f} {flag}"
+        )
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
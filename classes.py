@@ -1,16 +1,150 @@
 from typing import Any, Callable as TypingCallable, Union, Tuple
 from abc import ABC, abstractmethod
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from itertools import repeat
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+from operator import itemgetter
+from types import MappingProxyType
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import hashlib
+import importlib
+import heapq
+import inspect
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import queue
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
 
 
 class KeyGetter:
+    __slots__ = ("key",)
+
     def __init__(self, key):
         self.key = key
 
 
 class Signature:
+    __slots__ = ("args", "kwargs", "_binder")
+
     def __init__(self, *args, **kwargs):
         self.args = list(args)
         self.kwargs = kwargs
+        self._binder = None
+
+    def freeze(self):
+        """Make the Signature read-only and precompile its argument binding.
+
+        Context.resolve_keys of a frozen Signature only does the KeyGetter
+        lookups; literal arguments are prepared once.
+        """
+        self.args = tuple(self.args)
+        self.kwargs = MappingProxyType(dict(self.kwargs))
+        self._binder = self.compile()
+        return self
+
+    def read_keys(self):
+        """Keys of the KeyGetters among the arguments, in order."""
+        return [
+            parameter.key
+            for parameter in (*self.args, *self.kwargs.values())
+            if isinstance(parameter, KeyGetter)
+        ]
+
+    @property
+    def frozen(self):
+        return self._binder is not None
+
+    def compile(self):
+        """Return a function binding this Signature against a Context.
+
+        The returned args and kwargs may be shared between calls and must not
+        be modified.
+        """
+        get_args = self._compile_args(tuple(self.args))
+        get_kwargs = self._compile_kwargs(dict(self.kwargs))
+        if get_kwargs is None:
+            kwargs = MappingProxyType({})
+
+            def bind(context):
+                return get_args(context), kwargs
+
+        else:
+
+            def bind(context):
+                return get_args(context), get_kwargs(context)
+
+        return bind
+
+    @staticmethod
+    def _compile_args(args):
+        arg_keys = [
+            (position, arg.key)
+            for position, arg in enumerate(args)
+            if isinstance(arg, KeyGetter)
+        ]
+        if not arg_keys:
+            return lambda context: args
+        if len(arg_keys) == len(args):
+            if len(arg_keys) == 1:
+                key = arg_keys[0][1]
+                return lambda context: (context[key],)
+            return itemgetter(*(key for _, key in arg_keys))
+
+        template = list(args)
+
+        def get_args(context):
+            resolved = template.copy()
+            for position, key in arg_keys:
+                resolved[position] = context[key]
+            return resolved
+
+        return get_args
+
+    @staticmethod
+    def _compile_kwargs(kwargs):
+        if not kwargs:
+            return None
+        kwarg_keys = [
+            (name, value.key)
+            for name, value in kwargs.items()
+            if isinstance(value, KeyGetter)
+        ]
+        if not kwarg_keys:
+            return lambda context: kwargs
+        if len(kwarg_keys) == len(kwargs):
+            return lambda context: {name: context[key] for name, key in kwarg_keys}
+
+        def get_kwargs(context):
+            resolved = kwargs.copy()
+            for name, key in kwarg_keys:
+                resolved[name] = context[key]
+            return resolved
+
+        return get_kwargs
 
 
 class Context(dict):
@@ -21,12 +155,244 @@ class Context(dict):
             return parameter
 
     def resolve_keys(self, signature: Signature):
+        if signature._binder is not None:
+            return signature._binder(self)
         args = [self._resolve_key(arg) for arg in signature.args]
         kwargs = {k: self._resolve_key(v) for k, v in signature.kwargs.items()}
         return args, kwargs
 
+    def scope(self, mapping=None):
+        """Return a ScopedContext reading through to this one."""
+        return ScopedContext(self, mapping)
+
+
+class ScopedContext(Context):
+    """Context reading through to a parent context and writing locally.
+
+    mapping ({parent_key: scope_key}, like map_ctx) makes parent values visible
+    under other keys without copying them. Local entries reach the parent only
+    through merge(). Iteration, len() and items() see the local entries only,
+    use flatten() for everything visible.
+    """
+
+    def __init__(self, parent, mapping=None):
+        super().__init__()
+        self.parent = parent
+        self.mapping = (
+            {k_to: k_from for k_from, k_to in mapping.items()} if mapping else None
+        )
+
+    def __missing__(self, key):
+        if self.mapping is not None:
+            key = self.mapping.get(key, key)
+        return self.parent[key]
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        if self.mapping is not None:
+            key = self.mapping.get(key, key)
+        return key in self.parent
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def merge(self, keys=None):
+        """Write local entries (all, or only the given keys) to the parent."""
+        if keys is None:
+            keys = list(dict.keys(self))
+        for key in keys:
+            self.parent[key] = dict.__getitem__(self, key)
+
+    def flatten(self):
+        if isinstance(self.parent, ScopedContext):
+            visible = self.parent.flatten()
+        else:
+            visible = dict(self.parent)
+        if self.mapping is not None:
+            for k_to, k_from in self.mapping.items():
+                if k_from in visible:
+                    visible[k_to] = visible[k_from]
+        visible.update(self)
+        return Context(visible)
+
+
+class _RecordingContext(ScopedContext):
+    """Overlay remembering the values read from the parent."""
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.reads = {}
+
+    def __missing__(self, key):
+        value = super().__missing__(key)
+        self.reads[key] = value
+        return value
+
+
+class BatchContext(Context):
+    """Context of many records at once, every key holds a column of values."""
+
+    @classmethod
+    def from_records(cls, records):
+        records = list(records)
+        keys = dict.fromkeys(key for record in records for key in record)
+        return cls({key: [record[key] for record in records] for key in keys})
+
+    @property
+    def size(self):
+        for column in self.values():
+            return len(column)
+        return 0
+
+    def records(self):
+        columns = list(self.items())
+        return [
+            Context({key: column[index] for key, column in columns})
+            for index in range(self.size)
+        ]
+
+
+class _RowContext(Context):
+    """One record of a BatchContext, writes stay local."""
+
+    def __init__(self, batch, index):
+        super().__init__()
+        self.batch = batch
+        self.index = index
+
+    def __missing__(self, key):
+        return self.batch[key][self.index]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.batch
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+_SharedPayload = namedtuple("_SharedPayload", "name kind size shape dtype")
+
+
+def _is_ndarray(value):
+    return type(value).__name__ == "ndarray" and type(value).__module__ == "numpy"
+
+
+def _share(value, threshold, segments):
+    """Move large bytes and numpy arrays into shared memory, keep the rest."""
+    if isinstance(value, (bytes, bytearray)) and len(value) >= threshold > 0:
+        shm = SharedMemory(create=True, size=max(len(value), 1))
+        segments.append(shm)
+        shm.buf[: len(value)] = value
+        return _SharedPayload(shm.name, "bytes", len(value), None, None)
+    if _is_ndarray(value) and value.nbytes >= threshold > 0:
+        import numpy
+
+        shm = SharedMemory(create=True, size=max(value.nbytes, 1))
+        segments.append(shm)
+        numpy.ndarray(value.shape, value.dtype, buffer=shm.buf)[...] = value
+        return _SharedPayload(
+            shm.name, "ndarray", value.nbytes, value.shape, value.dtype.str
+        )
+    return value
+
+
+def _unshare(value, segments, copy):
+    """Rebuild a value moved by _share; arrays are views unless copy is set."""
+    if not isinstance(value, _SharedPayload):
+        return value
+    shm = SharedMemory(name=value.name)
+    segments.append(shm)
+    if value.kind == "bytes":
+        return bytes(shm.buf[: value.size])
+    import numpy
+
+    array = numpy.ndarray(value.shape, numpy.dtype(value.dtype), buffer=shm.buf)
+    return array.copy() if copy else array
+
+
+def _release_segments(segments, unlink):
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:  # a view escaped, the mapping goes with the process
+            continue
+        if unlink:
+            shm.unlink()
+    segments.clear()
+
+
+def _call_in_worker(payload, threshold):
+    func, args, kwargs = pickle.loads(payload)
+    segments = []
+    args = [_unshare(arg, segments, copy=False) for arg in args]
+    kwargs = {name: _unshare(arg, segments, copy=False) for name, arg in kwargs.items()}
+    result_segments = []
+    try:
+        result = _share(func(*args, **kwargs), threshold, result_segments)
+    finally:
+        del args, kwargs
+        _release_segments(segments, unlink=False)
+    # the parent unlinks the result segments after reading them
+    _release_segments(result_segments, unlink=False)
+    return result
+
+
+def _is_remote(obj):
+    """Tell if obj is a Task that runs the same in a worker process."""
+    return (
+        isinstance(obj, Task)
+        and type(obj.protocol) is Protocols.TaskProtocols.BasicContext
+    )
+
+
+def _dump_task(task, value):
+    try:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as exception:
+        raise TypeError(
+            f"Task {task.func!r} (put_to={task.put_to!r}) cannot be sent "
+            f"to a worker process: {exception}"
+        ) from exception
+
+
+def _submit_task(task, context, executor, segments, threshold):
+    """Submit task with its arguments resolved in context to _call_in_worker."""
+    args, kwargs = context.resolve_keys(task.signature)
+    args = [_share(arg, threshold, segments) for arg in args]
+    kwargs = {name: _share(arg, threshold, segments) for name, arg in kwargs.items()}
+    payload = _dump_task(task, (task.func, args, kwargs))
+    return executor.submit(_call_in_worker, payload, threshold)
+
 
 class Protocols:
+    class Scoped:
+        """Runs another protocol in a ScopedContext of the given context.
+
+        Works for Tasks, Workflows and WorkflowGraphs alike: the inner protocol
+        sees the parent through the scope (renamed by mapping) and writes only
+        to the scope. The merge keys are written back afterwards, all local
+        keys when merge is None.
+        """
+
+        def __init__(self, protocol, mapping=None, merge=()):
+            self.protocol = protocol
+            self.mapping = mapping
+            self.merge = merge
+
+        def __call__(self, obj, context):
+            scope = ScopedContext(context, self.mapping)
+            out = self.protocol(obj, scope)
+            if inspect.isawaitable(out):
+                return self._merge_after(out, scope)
+            scope.merge(self.merge)
+            return out
+
+        async def _merge_after(self, awaitable, scope):
+            out = await awaitable
+            scope.merge(self.merge)
+            return out
+
     class TaskProtocols:
         class BasicContext:
             def __call__(self, task, context):
@@ -36,6 +402,145 @@ class Protocols:
                     context[task.put_to] = result
                 return result
 
+        class Cached(BasicContext):
+            """Memoizes task.func results by the resolved arguments.
+
+            Results are kept in memory in an LRU of at most maxsize entries
+            (None for unbounded); arguments of different types are different
+            calls, as in functools.lru_cache(typed=True). With directory given, they are also pickled
+            there and found again after a restart; disk entries are keyed by
+            the module and qualified name of the function, so only functions
+            importable by that name (not lambdas or closures) use the disk.
+            Arguments that can be neither hashed nor pickled are not cached.
+            """
+
+            def __init__(self, maxsize=128, directory=None):
+                self.maxsize = maxsize
+                self.directory = directory
+                self._memory = OrderedDict()
+                self._lock = threading.Lock()
+                self.hits = 0
+                self.disk_hits = 0
+                self.misses = 0
+                self.evictions = 0
+                if directory is not None:
+                    os.makedirs(directory, exist_ok=True)
+
+            def __call__(self, task, context):
+                args, kwargs = context.resolve_keys(task.signature)
+                key, digest = self._make_keys(task.func, args, kwargs)
+                if key is None:
+                    result = task.func(*args, **kwargs)
+                else:
+                    found, result = self._lookup(key, digest)
+                    if not found:
+                        result = task.func(*args, **kwargs)
+                        self._store(key, digest, result)
+                if task.put_to is not None:
+                    context[task.put_to] = result
+                return result
+
+            @property
+            def stats(self):
+                return {
+                    "hits": self.hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "size": len(self._memory),
+                }
+
+            def clear(self):
+                """Drop the in-memory entries, the disk tier is kept."""
+                with self._lock:
+                    self._memory.clear()
+
+            def _make_keys(self, func, args, kwargs):
+                args = tuple(args)
+                kwargs = tuple(sorted(kwargs.items()))
+                digest = None
+                # lambdas and closures share names, only importable functions
+                # identify their code on disk
+                name = None if self.directory is None else _func_path(func)
+                if name is not None:
+                    try:
+                        payload = pickle.dumps((name, args, kwargs), protocol=4)
+                    except Exception:
+                        pass
+                    else:
+                        digest = hashlib.sha256(payload).hexdigest()
+                types = tuple(type(value) for value in args) + tuple(
+                    type(value) for _, value in kwargs
+                )
+                key = (func, args, kwargs, types)
+                try:
+                    hash(key)
+                except TypeError:
+                    key = (func, digest) if digest is not None else None
+                return key, digest
+
+            def _lookup(self, key, digest):
+                with self._lock:
+                    if key in self._memory:
+                        self._memory.move_to_end(key)
+                        self.hits += 1
+                        return True, self._memory[key]
+                if digest is not None:
+                    try:
+                        with open(self._path(digest), "rb") as file:
+                            result = pickle.load(file)
+                    except FileNotFoundError:
+                        pass
+                    else:
+                        with self._lock:
+                            self.hits += 1
+                            self.disk_hits += 1
+                        self._remember(key, result)
+                        return True, result
+                with self._lock:
+                    self.misses += 1
+                return False, None
+
+            def _store(self, key, digest, result):
+                self._remember(key, result)
+                if digest is None:
+                    return
+                try:
+                    payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    return
+                # write to a temporary file first, so readers never see a partial one
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd, "wb") as file:
+                    file.write(payload)
+                os.replace(tmp_path, self._path(digest))
+
+            def _remember(self, key, result):
+                if self.maxsize == 0:
+                    return
+                with self._lock:
+                    self._memory[key] = result
+                    self._memory.move_to_end(key)
+                    if self.maxsize is not None:
+                        while len(self._memory) > self.maxsize:
+                            self._memory.popitem(last=False)
+                            self.evictions += 1
+
+            def _path(self, digest):
+                return os.path.join(self.directory, digest + ".pickle")
+
+        class Async:
+            """Awaits the result of task.func when it is awaitable."""
+
+            async def __call__(self, task, context):
+                args, kwargs = context.resolve_keys(task.signature)
+                result = task.func(*args, **kwargs)
+                if inspect.isawaitable(result):
+                    result = await result
+                if task.put_to is not None:
+                    context[task.put_to] = result
+                return result
+
     class WorkflowProtocols:
         class BasicContext:
             def __call__(self, workflow, context):
@@ -56,125 +561,3594 @@ class Protocols:
                 if workflow.return_key:
                     return context[workflow.return_key]
 
+        class Streaming:
+            """Pushes an iterable of contexts lazily through workflow.items.
+
+            Calling the protocol returns a generator of processed contexts, or
+            of their return_key values for a WorkflowWithAssumptions (whose
+            map_ctx and put_to are applied like in Sequential). Plain dicts are
+            wrapped in Context. With threaded=True every item runs in its own
+            thread and stages are connected by queues of buffer_size, so at
+            most that many contexts are between two stages, counting the one
+            the next stage works on.
+            """
+
+            _END = object()
+
+            def __init__(self, buffer_size=1, threaded=False):
+                self.buffer_size = buffer_size
+                self.threaded = threaded
+
+            def __call__(self, workflow, contexts):
+                stages = self._get_stages(workflow)
+                return_key = getattr(workflow, "return_key", None)
+                if self.threaded:
+                    outs = self._run_threaded(stages, contexts)
+                else:
+                    outs = self._run_lazy(stages, contexts)
+                if return_key:
+                    return (context[return_key] for context in outs)
+                return outs
+
+            def _get_stages(self, workflow):
+                if not isinstance(workflow, WorkflowWithAssumptions):
+                    return list(workflow.items)
+
+                def map_ctx(context):
+                    for k_from, k_to in workflow.map_ctx.items():
+                        context[k_to] = context[k_from]
+
+                def put_to(item):
+                    def stage(context):
+                        context[workflow.put_to] = item(context)
+
+                    return stage
+
+                stages = [map_ctx] if workflow.map_ctx else []
+                return stages + [put_to(item) for item in workflow.items]
+
+            def _as_context(self, context):
+                return context if isinstance(context, Context) else Context(context)
+
+            def _run_lazy(self, stages, contexts):
+                for context in contexts:
+                    context = self._as_context(context)
+                    for stage in stages:
+                        stage(context)
+                    yield context
+
+            def _run_threaded(self, stages, contexts):
+                stop = threading.Event()
+                # a context holds a slot of a gap from being put into its queue
+                # until the next stage passed it on, so in-hand ones count too
+                gaps = [
+                    (queue.Queue(), threading.Semaphore(self.buffer_size))
+                    for _ in range(len(stages) + 1)
+                ]
+                threads = [
+                    threading.Thread(
+                        target=self._feed, args=(contexts, gaps[0], stop), daemon=True
+                    )
+                ]
+                for stage, inbox, outbox in zip(stages, gaps, gaps[1:]):
+                    threads.append(
+                        threading.Thread(
+                            target=self._work,
+                            args=(stage, inbox, outbox, stop),
+                            daemon=True,
+                        )
+                    )
+                for thread in threads:
+                    thread.start()
+                try:
+                    while True:
+                        item = self._get(gaps[-1], stop)
+                        gaps[-1][1].release()
+                        if item is self._END:
+                            return
+                        if isinstance(item, BaseException):
+                            raise item
+                        yield item
+                finally:
+                    stop.set()
+
+            def _feed(self, contexts, outbox, stop):
+                contexts = iter(contexts)
+                while self._reserve(outbox, stop):
+                    try:
+                        item = self._as_context(next(contexts))
+                    except StopIteration:
+                        item = self._END
+                    except Exception as exception:
+                        item = exception
+                    outbox[0].put(item)
+                    if item is self._END or isinstance(item, BaseException):
+                        return
+
+            def _work(self, stage, inbox, outbox, stop):
+                while True:
+                    item = self._get(inbox, stop)
+                    if stop.is_set():
+                        return
+                    if item is not self._END and not isinstance(item, BaseException):
+                        try:
+                            stage(item)
+                        except Exception as exception:
+                            item = exception
+                    if not self._reserve(outbox, stop):
+                        return
+                    outbox[0].put(item)
+                    inbox[1].release()
+                    if item is self._END or isinstance(item, BaseException):
+                        return
+
+            def _reserve(self, gap, stop):
+                while not stop.is_set():
+                    if gap[1].acquire(timeout=0.05):
+                        return True
+                return False
+
+            def _get(self, gap, stop):
+                while not stop.is_set():
+                    try:
+                        return gap[0].get(timeout=0.05)
+                    except queue.Empty:
+                        pass
+                return self._END
+
+        class Async:
+            async def __call__(self, workflow, context):
+                last_out = None
+                for item in workflow.items:
+                    last_out = item(context)
+                    if inspect.isawaitable(last_out):
+                        last_out = await last_out
+                return last_out
+
     class WorkflowGraphProtocols:
         class Balanced:
             def __call__(self, graph, context):
                 last_out = None
-                for key in self._traverse(graph):
-                    print(f"this key {key}")
-                    if isinstance(key, tuple):  # then it is an edge
-                        obj = graph.edges[key]
-                    else:
-                        obj = graph.nodes[key]
-                    last_out = obj(context)
+                plan = self.compile(graph)
+                for key, obj in zip(self._keys(graph), plan):
+                    last_out = _call_item(key, obj, context)
                 return last_out
 
+            def compile(self, graph):
+                """Return the execution plan, cached until the graph changes."""
+                return graph._cached((type(self), "plan"), lambda: self._compile(graph))
+
+            def _compile(self, graph):
+                return [self._get_item(graph, key) for key in self._traverse(graph)]
+
+            def _keys(self, graph):
+                """Return the item keys in plan order, cached like the plan."""
+                return graph._cached("keys", lambda: list(self._traverse(graph)))
+
+            def _get_item(self, graph, key):
+                if isinstance(key, tuple):  # then it is an edge
+                    return graph.edges[key]
+                return graph.nodes[key]
+
             def _get_edge_dict(self, graph):
-                edge_dict = {}
-                for src, tar in graph.edges.keys():
-                    if src in edge_dict:
-                        edge_dict[src].add(tar)
-                    else:
-                        edge_dict[src] = {
-                            tar,
-                        }
-                return edge_dict
+                return graph.engine.edge_dict(graph)
 
-            def _traverse(self, graph):
+            def _get_dependencies(self, graph):
+                """Return (successors, pending) for items reachable from the root.
+
+                An edge waits for its source node, a node waits for all of its
+                reachable incoming edges; pending counts what each item waits for.
+                """
                 edge_dict = self._get_edge_dict(graph)
+                successors = {}
+                pending = {graph.root_node: 0}
+                stack = [graph.root_node]
+                while stack:
+                    node_key = stack.pop()
+                    edge_keys = [(node_key, tar) for tar in edge_dict.get(node_key, ())]
+                    successors[node_key] = edge_keys
+                    for edge_key in edge_keys:
+                        pending[edge_key] = 1
+                        target_node_key = edge_key[-1]
+                        successors[edge_key] = [target_node_key]
+                        if target_node_key in pending:
+                            pending[target_node_key] += 1
+                        else:
+                            pending[target_node_key] = 1
+                            stack.append(target_node_key)
+                return successors, pending
 
-                node_keys = set((graph.root_node,))
-                edge_keys_set = set()
+            def _traverse(self, graph):
+                for level in self._levels(graph):
+                    yield from level
+
+            def _levels(self, graph):
+                """Return lists of keys: nodes, their outgoing edges, target nodes..."""
+                return graph._cached("levels", lambda: self._build_levels(graph))
+
+            def _build_levels(self, graph):
+                report = graph.validate()
+                if report.cycle_reachable:
+                    path = " -> ".join(map(repr, report.cycle))
+                    raise ValueError(f"Graph edges form a cycle: {path}")
+                return list(graph.engine.levels(graph))
+
+        class Parallel(Balanced):
+            """Runs every item of a level concurrently in a thread pool.
+
+            Items of a level write to private overlays of the context, merged in
+            level order after all of them finished. If any item raised, overlays
+            of the items before it are merged and the error of the first failing
+            item (in level order) is raised.
+            """
+
+            def __init__(self, max_workers=None, executor=None):
+                self.max_workers = max_workers
+                self.executor = executor
+
+            def __call__(self, graph, context):
+                if self.executor is not None:
+                    return self._run(graph, context, self.executor)
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    return self._run(graph, context, executor)
+
+            def _compile(self, graph):
+                return [
+                    [self._get_item(graph, key) for key in level]
+                    for level in self._levels(graph)
+                ]
+
+            def _run(self, graph, context, executor):
+                last_out = None
+                plan = self.compile(graph)
+                for keys, objs in zip(self._levels(graph), plan):
+                    if len(objs) == 1:
+                        last_out = _call_item(keys[0], objs[0], context)
+                        continue
+                    last_out = self._run_level(keys, objs, context, executor)
+                return last_out
+
+            def _run_level(self, keys, objs, context, executor):
+                overlays = [ScopedContext(context) for _ in objs]
+                futures = [
+                    executor.submit(_call_item, key, obj, overlay)
+                    for key, obj, overlay in zip(keys, objs, overlays)
+                ]
+                wait(futures)
+                last_out = None
+                for future, overlay in zip(futures, overlays):
+                    exception = future.exception()
+                    if exception is not None:
+                        raise exception
+                    overlay.merge()
+                    last_out = future.result()
+                return last_out
+
+        class ProcessPool(Parallel):
+            """Runs the Tasks of a level in worker processes.
 
-                while node_keys:
+            Workers get only the resolved arguments of a Task and send back
+            only its result, put_to is written by the parent. bytes and numpy
+            arrays of at least shm_threshold bytes travel through shared memory
+            instead of the pipe; workers see arrays as views of it. Tasks with
+            another protocol than BasicContext and other items run in the
+            parent. Task functions and arguments must be picklable (functions
+            by reference, i.e. module level), otherwise TypeError is raised.
+            """
 
-                    edge_keys_set.clear()
-                    for src_node_key in node_keys:
-                        yield src_node_key
-                        if src_node_key in edge_dict:
-                            edge_keys_set.update(
-                                {
-                                    (src_node_key, target_node_key)
-                                    for target_node_key in edge_dict[src_node_key]
-                                }
+            def __init__(
+                self,
+                max_workers=None,
+                executor=None,
+                shm_threshold=1 << 20,
+                mp_context=None,
+            ):
+                super().__init__(max_workers, executor)
+                self.shm_threshold = shm_threshold
+                self.mp_context = mp_context
+
+            def __call__(self, graph, context):
+                if self.executor is not None:
+                    return self._run(graph, context, self.executor)
+                with ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=self.mp_context
+                ) as executor:
+                    return self._run(graph, context, executor)
+
+            def _compile(self, graph):
+                levels = super()._compile(graph)
+                for objs in levels:
+                    for obj in objs:
+                        if _is_remote(obj):
+                            _dump_task(obj, obj.func)
+                return levels
+
+            def _run(self, graph, context, executor):
+                last_out = None
+                plan = self.compile(graph)
+                for keys, objs in zip(self._levels(graph), plan):
+                    if len(objs) == 1 and not _is_remote(objs[0]):
+                        last_out = _call_item(keys[0], objs[0], context)
+                        continue
+                    last_out = self._run_level(keys, objs, context, executor)
+                return last_out
+
+            def _run_level(self, keys, objs, context, executor):
+                segments = []
+                futures = {}
+                try:
+                    for index, obj in enumerate(objs):
+                        if _is_remote(obj):
+                            futures[index] = _submit_task(
+                                obj, context, executor, segments, self.shm_threshold
                             )
 
-                    node_keys.clear()
-                    for edge_key in edge_keys_set:
-                        yield edge_key
-                        node_keys.add(edge_key[-1])
+                    outcomes = {}
+                    overlays = {}
+                    for index, obj in enumerate(objs):
+                        if index in futures:
+                            continue
+                        overlays[index] = ScopedContext(context)
+                        try:
+                            out = _call_item(keys[index], obj, overlays[index])
+                            outcomes[index] = (out, None)
+                        except Exception as exception:
+                            outcomes[index] = (None, exception)
+                    wait(futures.values())
 
+                    last_out = None
+                    for index, obj in enumerate(objs):
+                        if index in futures:
+                            exception = futures[index].exception()
+                            if exception is not None:
+                                raise exception
+                            result_segments = []
+                            last_out = _unshare(
+                                futures.pop(index).result(), result_segments, copy=True
+                            )
+                            _release_segments(result_segments, unlink=True)
+                            if obj.put_to is not None:
+                                context[obj.put_to] = last_out
+                        else:
+                            last_out, exception = outcomes[index]
+                            if exception is not None:
+                                raise exception
+                            overlays[index].merge()
+                    return last_out
+                finally:
+                    wait(futures.values())
+                    _release_segments(segments, unlink=True)
+                    # results left unread because of an earlier error
+                    for future in futures.values():
+                        if future.exception() is None:
+                            result_segments = []
+                            _unshare(future.result(), result_segments, copy=False)
+                            _release_segments(result_segments, unlink=True)
 
-class Task:
-    def __init__(
-        self,
-        func: TypingCallable,
-        signature: Signature,
-        put_to: str = None,
-        protocol=Protocols.TaskProtocols.BasicContext(),
-    ):
-        self.func = func
-        self.signature = signature
-        self.put_to = put_to
-        self.protocol = protocol
+        class CriticalPath(Parallel):
+            """Starts ready items in the thread pool longest remaining path first.
 
-    def __call__(self, context: Context) -> Any:
-        return self.protocol(self, context)
+            Every item runs once, as soon as its own predecessors finished, and
+            writes to a private overlay merged into the context when it is done.
+            Runtimes are remembered between calls in timings (a moving average
+            per item key, items never timed count as default_cost seconds). The
+            priority of an item is its expected runtime plus the longest
+            expected chain after it. last_report holds the makespan predicted
+            from the timings before a call and the measured one.
+            """
 
+            def __init__(
+                self, max_workers=None, executor=None, smoothing=0.5, default_cost=1e-3
+            ):
+                super().__init__(max_workers, executor)
+                self.smoothing = smoothing
+                self.default_cost = default_cost
+                self.timings = {}
+                self.last_report = None
 
-class Workflow:
-    def __init__(self, items, protocol=None):
-        self.items = items
-        self.protocol = protocol
+            def _compile(self, graph):
+                successors, pending = self._get_dependencies(graph)
+                objs = {key: self._get_item(graph, key) for key in pending}
+                counts = dict(pending)
+                order = [key for key, count in counts.items() if count == 0]
+                for key in order:
+                    for successor in successors[key]:
+                        counts[successor] -= 1
+                        if counts[successor] == 0:
+                            order.append(successor)
+                return successors, pending, objs, order
 
-    def __call__(self, context: Context):
-        return self.protocol(self, context)
+            def priorities(self, graph):
+                """Return {key: expected runtime of the longest path from key}."""
+                successors, _, _, order = self.compile(graph)
+                priority = {}
+                for key in reversed(order):
+                    priority[key] = self._cost(key) + max(
+                        (priority[successor] for successor in successors[key]),
+                        default=0.0,
+                    )
+                return priority
 
+            def _cost(self, key):
+                return self.timings.get(key, self.default_cost)
 
-class WorkflowWithAssumptions(Workflow):
-    def __init__(self, *args, put_to=None, map_ctx=None, return_key=None, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.put_to = put_to
-        self.map_ctx = map_ctx
-        self.return_key = return_key
+            def _workers(self, executor):
+                if self.max_workers is not None:
+                    return self.max_workers
+                return getattr(
+                    executor, "_max_workers", min(32, (os.cpu_count() or 1) + 4)
+                )
 
+            def _run(self, graph, context, executor):
+                successors, pending, objs, rank, priority, workers = self._plan(
+                    graph, executor
+                )
+                predicted = self._simulate(successors, pending, priority, rank, workers)
+                pending = dict(pending)
+                ready = []
+                for key, count in pending.items():
+                    if count == 0:
+                        self._push(ready, key, priority, rank)
+                running = {}
+                exception = None
+                last_out = None
+                start = time.perf_counter()
+                while running or (ready and exception is None):
+                    while ready and exception is None and len(running) < workers:
+                        _, _, key = heapq.heappop(ready)
+                        overlay = ScopedContext(context)
+                        future = self._submit(executor, key, objs[key], overlay)
+                        running[future] = (key, overlay)
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in sorted(done, key=lambda f: rank[running[f][0]]):
+                        key, overlay = running.pop(future)
+                        if future.exception() is not None:
+                            exception = exception or future.exception()
+                            continue
+                        last_out, elapsed = future.result()
+                        self._record(key, elapsed)
+                        overlay.merge()
+                        for successor in successors[key]:
+                            pending[successor] -= 1
+                            if pending[successor] == 0:
+                                self._push(ready, successor, priority, rank)
+                self._report(predicted, time.perf_counter() - start, workers, priority)
+                if exception is not None:
+                    raise exception
+                return last_out
 
-class WorkflowGraph:
-    def __init__(
-        self, nodes: dict = None, edges: dict = None, root_node=None, protocol=None
-    ):
-        self.nodes = nodes if nodes else dict()
-        self.edges = edges if edges else dict()
-        self.root_node = root_node
-        self.protocol = protocol
+            def _plan(self, graph, executor):
+                successors, pending, objs, order = self.compile(graph)
+                if len(order) < len(pending):
+                    ordered = set(order)
+                    blocked = [key for key in pending if key not in ordered]
+                    raise ValueError(f"Graph items wait on each other: {blocked}")
+                rank = {key: index for index, key in enumerate(order)}
+                priority = self.priorities(graph)
+                return (
+                    successors,
+                    pending,
+                    objs,
+                    rank,
+                    priority,
+                    self._workers(executor),
+                )
 
-    def __call__(self, context: Context):
-        return self.protocol(self, context)
+            @staticmethod
+            def _push(ready, key, priority, rank):
+                heapq.heappush(ready, (-priority[key], rank[key], key))
 
-    def traverse(self):
-        yield from self.protocol._traverse(self)
+            def _report(self, predicted, actual, workers, priority):
+                self.last_report = {
+                    "predicted": predicted,
+                    "actual": actual,
+                    "workers": workers,
+                    "critical_path": max(priority.values(), default=0.0),
+                }
 
+            def _submit(self, executor, key, obj, overlay):
+                return executor.submit(self._timed, key, obj, overlay)
 
-class SystemManager:
-    """Abstract class providing factory object for all classes"""
+            @staticmethod
+            def _timed(key, obj, context):
+                start = time.perf_counter()
+                out = _call_item(key, obj, context)
+                return out, time.perf_counter() - start
 
-    def __init__(self):
-        pass
+            def _record(self, key, elapsed):
+                previous = self.timings.get(key)
+                if previous is None:
+                    self.timings[key] = elapsed
+                else:
+                    self.timings[key] = previous + self.smoothing * (elapsed - previous)
 
-    def get_keygetter(self, *args, **kwargs):
-        return KeyGetter(*args, **kwargs)
+            def _simulate(self, successors, pending, priority, rank, workers):
+                """Return the makespan of the same list schedule with expected
+                runtimes."""
+                pending = dict(pending)
+                ready = [
+                    (-priority[key], rank[key], key)
+                    for key, count in pending.items()
+                    if count == 0
+                ]
+                heapq.heapify(ready)
+                running = []
+                now = 0.0
+                while ready or running:
+                    while ready and len(running) < workers:
+                        _, _, key = heapq.heappop(ready)
+                        heapq.heappush(running, (now + self._cost(key), rank[key], key))
+                    now, _, key = heapq.heappop(running)
+                    for successor in successors[key]:
+                        pending[successor] -= 1
+                        if pending[successor] == 0:
+                            heapq.heappush(
+                                ready,
+                                (-priority[successor], rank[successor], successor),
+                            )
+                return now
 
-    def get_signature(self, *args, **kwargs):
-        return Signature(*args, **kwargs)
+        class Hedged(CriticalPath):
+            """CriticalPath with deadlines and speculative copies of slow items.
 
-    def get_context(self, *args, **kwargs):
-        return Context(*args, **kwargs)
+            deadline limits a whole call and the timeout attribute of an item
+            (e.g. Task(timeout=...)) its own run, both in seconds. When one is
+            exceeded TimeoutError is raised without waiting for running
+            items, items not started yet are cancelled and their results are
+            never merged. An item with the idempotent attribute set is started
+            once more (up to max_copies runs at a time) when it runs longer
+            than the given percentile of its last runtimes, once min_samples
+            were recorded; the first copy to finish wins and only its overlay
+            is merged, the others are abandoned. stats() reports runtime
+            percentiles, copies and timeouts per item key.
+            """
 
-    def get_task(self, *args, **kwargs):
-        return Task(*args, **kwargs)
+            _CANCELLED = object()
 
-    def get_workflow(self, *args, **kwargs):
-        return Workflow(*args, **kwargs)
+            def __init__(
+                self,
+                max_workers=None,
+                executor=None,
+                deadline=None,
+                percentile=0.95,
+                min_samples=5,
+                max_copies=2,
+                history=100,
+            ):
+                super().__init__(max_workers, executor)
+                self.deadline = deadline
+                self.percentile = percentile
+                self.min_samples = min_samples
+                self.max_copies = max_copies
+                self.history = history
+                self.samples = {}
+                self.counters = {}
 
-    def get_workflowgraph(self, *args, **kwargs):
-        return WorkflowGraph(*args, **kwargs)
+            def __call__(self, graph, context):
+                if self.executor is not None:
+                    return self._run(graph, context, self.executor)
+                executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                try:
+                    return self._run(graph, context, executor)
+                finally:
+                    # abandoned copies may still run, they are not waited for
+                    executor.shutdown(wait=False, cancel_futures=True)
+
+            def stats(self):
+                stats = {}
+                for key, samples in self.samples.items():
+                    ordered = sorted(samples)
+                    stats[key] = {
+                        "runs": len(ordered),
+                        "p50": self._percentile(ordered, 0.5),
+                        "p90": self._percentile(ordered, 0.9),
+                        "p99": self._percentile(ordered, 0.99),
+                        "max": ordered[-1],
+                    }
+                for key, counters in self.counters.items():
+                    stats.setdefault(key, {}).update(counters)
+                return stats
+
+            @staticmethod
+            def _percentile(ordered, fraction):
+                return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+            def _record(self, key, elapsed):
+                super()._record(key, elapsed)
+                samples = self.samples.get(key)
+                if samples is None:
+                    samples = self.samples[key] = deque(maxlen=self.history)
+                samples.append(elapsed)
+
+            def _count(self, key, name):
+                counters = self.counters.setdefault(
+                    key, {"copies": 0, "copy_wins": 0, "timeouts": 0}
+                )
+                counters[name] += 1
+
+            def _threshold(self, key, obj):
+                samples = self.samples.get(key, ())
+                if not getattr(obj, "idempotent", False) or len(samples) < max(
+                    self.min_samples, 1
+                ):
+                    return None
+                return self._percentile(sorted(samples), self.percentile)
+
+            def _run(self, graph, context, executor):
+                successors, pending, objs, rank, priority, workers = self._plan(
+                    graph, executor
+                )
+                predicted = self._simulate(successors, pending, priority, rank, workers)
+                thresholds = {key: self._threshold(key, objs[key]) for key in objs}
+                timeouts = {key: getattr(objs[key], "timeout", None) for key in objs}
+                pending = dict(pending)
+                ready = []
+                for key, count in pending.items():
+                    if count == 0:
+                        self._push(ready, key, priority, rank)
+                running = {}  # future: (key, overlay, copy number)
+                copies = {}  # key: [first start, futures]
+                cancelled = threading.Event()
+                exception = None
+                last_out = None
+                start = time.perf_counter()
+                deadline = None if self.deadline is None else start + self.deadline
+                try:
+                    while running or ready:
+                        now = time.perf_counter()
+                        exception = self._expired(now, deadline, copies, timeouts)
+                        if exception is not None:
+                            break
+                        while ready and len(running) < workers:
+                            _, _, key = heapq.heappop(ready)
+                            copies[key] = [now, []]
+                            self._launch(
+                                executor, key, objs, context, running, copies, cancelled
+                            )
+                        for key, (first_start, futures) in copies.items():
+                            if len(running) >= workers:
+                                break
+                            threshold = thresholds[key]
+                            if (
+                                threshold is not None
+                                and len(futures) < self.max_copies
+                                and now - first_start > threshold * len(futures)
+                            ):
+                                self._count(key, "copies")
+                                self._launch(
+                                    executor,
+                                    key,
+                                    objs,
+                                    context,
+                                    running,
+                                    copies,
+                                    cancelled,
+                                )
+                        done, _ = wait(
+                            running,
+                            timeout=self._wait_time(
+                                now, deadline, copies, timeouts, thresholds
+                            ),
+                            return_when=FIRST_COMPLETED,
+                        )
+                        for future in sorted(done, key=lambda f: rank[running[f][0]]):
+                            entry = running.pop(future, None)
+                            if entry is None or entry[0] not in copies:
+                                continue  # a copy of the item already won
+                            key, overlay, number = entry
+                            futures = copies[key][1]
+                            futures.remove(future)
+                            error = future.exception()
+                            if error is not None:
+                                if not futures:
+                                    raise error
+                                continue
+                            out, elapsed = future.result()
+                            if out is self._CANCELLED:
+                                continue
+                            del copies[key]
+                            for loser in futures:
+                                loser.cancel()
+                                running.pop(loser, None)
+                            if number:
+                                self._count(key, "copy_wins")
+                            last_out = out
+                            self._record(key, elapsed)
+                            overlay.merge()
+                            for successor in successors[key]:
+                                pending[successor] -= 1
+                                if pending[successor] == 0:
+                                    self._push(ready, successor, priority, rank)
+                finally:
+                    cancelled.set()
+                    for future in running:
+                        future.cancel()
+                    self._report(
+                        predicted, time.perf_counter() - start, workers, priority
+                    )
+                if exception is not None:
+                    raise exception
+                return last_out
+
+            def _launch(self, executor, key, objs, context, running, copies, cancelled):
+                overlay = ScopedContext(context)
+                futures = copies[key][1]
+                future = executor.submit(
+                    self._guarded, key, objs[key], overlay, cancelled
+                )
+                running[future] = (key, overlay, len(futures))
+                futures.append(future)
+
+            def _guarded(self, key, obj, context, cancelled):
+                if cancelled.is_set():
+                    return self._CANCELLED, 0.0
+                return self._timed(key, obj, context)
+
+            def _expired(self, now, deadline, copies, timeouts):
+                if deadline is not None and now >= deadline:
+                    return TimeoutError(
+                        f"Graph exceeded its deadline of {self.deadline} s"
+                    )
+                for key, (first_start, _) in copies.items():
+                    timeout = timeouts[key]
+                    if timeout is not None and now - first_start >= timeout:
+                        self._count(key, "timeouts")
+                        return TimeoutError(
+                            f"Graph item {key!r} exceeded its timeout of {timeout} s"
+                        )
+                return None
+
+            def _wait_time(self, now, deadline, copies, timeouts, thresholds):
+                """Seconds until the next deadline, timeout or copy is due."""
+                times = [] if deadline is None else [deadline]
+                for key, (first_start, futures) in copies.items():
+                    if timeouts[key] is not None:
+                        times.append(first_start + timeouts[key])
+                    if thresholds[key] is not None and len(futures) < self.max_copies:
+                        times.append(first_start + thresholds[key] * len(futures))
+                if not times:
+                    return None
+                return max(0.0, min(times) - now)
+
+        class ResourceAware(CriticalPath):
+            """Runs items in pools matching their resource class, within limits.
+
+            The class of an item is its resource attribute (e.g.
+            Task(resource="cpu")), default_resource when it has none; its
+            weight attribute (1 by default) counts against the limit of its
+            class. Running items of a class never weigh more than its limit in
+            total, except a single item heavier than the limit running alone;
+            give the memory class a budget and weights in the same unit (e.g.
+            bytes) to bound memory use. Items of a class at its limit wait
+            while ready items of other classes start, in the CriticalPath
+            priority order. cpu Tasks with the BasicContext protocol run in
+            worker processes when processes is set (see ProcessPool for the
+            requirements), everything else in a thread pool.
+            """
+
+            def __init__(
+                self,
+                limits=None,
+                default_resource="io",
+                processes=True,
+                shm_threshold=1 << 20,
+                mp_context=None,
+                thread_executor=None,
+                process_executor=None,
+                smoothing=0.5,
+                default_cost=1e-3,
+            ):
+                super().__init__(smoothing=smoothing, default_cost=default_cost)
+                self.limits = {"io": 32, "cpu": os.cpu_count() or 1, "memory": 1}
+                self.limits.update(limits or {})
+                self.default_resource = default_resource
+                self.processes = processes
+                self.thread_executor = thread_executor
+                self.process_executor = process_executor
+                self.shm_threshold = shm_threshold
+                self.mp_context = mp_context
+
+            def __call__(self, graph, context):
+                with contextlib.ExitStack() as stack:
+                    threads = self.thread_executor
+                    if threads is None:
+                        threads = stack.enter_context(
+                            ThreadPoolExecutor(max_workers=self._thread_count())
+                        )
+                    processes = self.process_executor
+                    if processes is None and self.processes:
+                        processes = stack.enter_context(
+                            ProcessPoolExecutor(
+                                max_workers=math.ceil(self.limits["cpu"]),
+                                mp_context=self.mp_context,
+                            )
+                        )
+                    return self._run(graph, context, threads, processes)
+
+            def _thread_count(self):
+                limits = [
+                    limit
+                    for resource, limit in self.limits.items()
+                    if not (self.processes and resource == "cpu")
+                ]
+                return max(1, math.ceil(sum(limits)))
+
+            def _limits(self):
+                return self.limits
+
+            def _workers(self, executor):
+                return max(1, math.ceil(sum(self._limits().values())))
+
+            def _resource(self, obj):
+                resource = getattr(obj, "resource", None) or self.default_resource
+                if resource not in self.limits:
+                    raise ValueError(f"No limit is set for resource class {resource!r}")
+                return resource
+
+            def _run(self, graph, context, threads, processes):
+                successors, pending, objs, rank, priority, workers = self._plan(
+                    graph, None
+                )
+                predicted = self._simulate(successors, pending, priority, rank, workers)
+                resources = {key: self._resource(obj) for key, obj in objs.items()}
+                weights = {key: getattr(obj, "weight", 1) for key, obj in objs.items()}
+                limits = self._limits()
+                used = dict.fromkeys(limits, 0)
+                pending = dict(pending)
+                ready = {resource: [] for resource in limits}
+                for key, count in pending.items():
+                    if count == 0:
+                        self._push(ready[resources[key]], key, priority, rank)
+                running = {}  # future: (key, overlay, start, input segments or None)
+                exception = None
+                last_out = None
+                start = time.perf_counter()
+                try:
+                    while running or (exception is None and any(ready.values())):
+                        for resource, heap in ready.items():
+                            while heap and exception is None:
+                                key = heap[0][2]
+                                if (
+                                    used[resource]
+                                    and used[resource] + weights[key] > limits[resource]
+                                ):
+                                    break  # blocked, other classes go on
+                                heapq.heappop(heap)
+                                used[resource] += weights[key]
+                                future, entry = self._launch(
+                                    key,
+                                    objs[key],
+                                    resources[key],
+                                    context,
+                                    threads,
+                                    processes,
+                                )
+                                running[future] = entry
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in sorted(done, key=lambda f: rank[running[f][0]]):
+                            key, overlay, launched, segments = running.pop(future)
+                            used[resources[key]] -= weights[key]
+                            if segments is not None:
+                                _release_segments(segments, unlink=True)
+                            if future.exception() is not None:
+                                exception = exception or future.exception()
+                                continue
+                            if segments is None:
+                                last_out, elapsed = future.result()
+                            else:
+                                last_out = self._receive(future)
+                                elapsed = time.perf_counter() - launched
+                                if objs[key].put_to is not None:
+                                    overlay[objs[key].put_to] = last_out
+                            self._record(key, elapsed)
+                            overlay.merge()
+                            for successor in successors[key]:
+                                pending[successor] -= 1
+                                if pending[successor] == 0:
+                                    self._push(
+                                        ready[resources[successor]],
+                                        successor,
+                                        priority,
+                                        rank,
+                                    )
+                finally:
+                    wait(running)
+                    for future, (_, _, _, segments) in running.items():
+                        if segments is not None:
+                            _release_segments(segments, unlink=True)
+                            if future.exception() is None:
+                                self._receive(future)
+                self._report(predicted, time.perf_counter() - start, workers, priority)
+                if exception is not None:
+                    raise exception
+                return last_out
+
+            def _launch(self, key, obj, resource, context, threads, processes):
+                overlay = ScopedContext(context)
+                if resource == "cpu" and processes is not None and _is_remote(obj):
+                    segments = []
+                    try:
+                        future = _submit_task(
+                            obj, overlay, processes, segments, self.shm_threshold
+                        )
+                    except BaseException:
+                        _release_segments(segments, unlink=True)
+                        raise
+                    return future, (key, overlay, time.perf_counter(), segments)
+                future = threads.submit(self._timed, key, obj, overlay)
+                return future, (key, overlay, None, None)
+
+            @staticmethod
+            def _receive(future):
+                result_segments = []
+                out = _unshare(future.result(), result_segments, copy=True)
+                _release_segments(result_segments, unlink=True)
+                return out
+
+        class Distributed(ResourceAware):
+            """Runs the Tasks of a graph on the workers of a Coordinator.
+
+            The context stays with the caller: a Task that ProcessPool would
+            send to a process is resolved here, only its function and
+            arguments go to a worker and the result is stored under put_to.
+            Tasks marked io or memory, Workflows and nested graphs run in
+            local threads. Without a cpu limit, as many Tasks are sent at a
+            time as workers are connected, so the CriticalPath order holds.
+            """
+
+            def __init__(
+                self, coordinator, limits=None, smoothing=0.5, default_cost=1e-3
+            ):
+                super().__init__(
+                    limits={"cpu": None, **(limits or {})},
+                    default_resource="cpu",
+                    process_executor=coordinator,
+                    shm_threshold=0,
+                    smoothing=smoothing,
+                    default_cost=default_cost,
+                )
+                self.coordinator = coordinator
+
+            def _limits(self):
+                limits = dict(self.limits)
+                if limits["cpu"] is None:
+                    limits["cpu"] = max(1, self.coordinator.stats()["workers"])
+                return limits
+
+        class Checkpointed(Balanced):
+            """Persists what every item wrote, so a failed run can be resumed.
+
+            After each completed item one record with its position in the plan,
+            the context entries it wrote and its output is appended to the file
+            at path (length prefixed pickles). Calling the graph again replays
+            the recorded entries into the context and continues with the first
+            item not completed. Records of another graph structure or of other
+            initial values of the keys the graph reads are ignored. The file is
+            removed after a successful run unless keep is set, in which case it
+            is marked as completed and the next call starts over.
+            """
+
+            _HEADER = struct.Struct("<Q")
+            _COMPLETED = "completed"
+
+            def __init__(self, path, keep=False, sync=False):
+                self.path = path
+                self.keep = keep
+                self.sync = sync
+                self.resumed = 0
+
+            def __call__(self, graph, context):
+                plan = self.compile(graph)
+                keys = self._keys(graph)
+                fingerprint = graph._cached(
+                    (type(self), "fingerprint"), lambda: self._fingerprint(graph)
+                )
+                header = (fingerprint, self._inputs_digest(graph, context))
+                records, valid_size = self._load(header)
+                last_out = None
+                for _, writes, last_out in records:
+                    for key, value in writes.items():
+                        context[key] = value
+                self.resumed = len(records)
+
+                with open(self.path, "r+b" if valid_size else "wb") as file:
+                    if valid_size:
+                        file.truncate(valid_size)
+                        file.seek(valid_size)
+                    else:
+                        self._write(file, header)
+                    for index in range(len(records), len(plan)):
+                        overlay = ScopedContext(context)
+                        last_out = _call_item(keys[index], plan[index], overlay)
+                        overlay.merge()
+                        self._write(file, (index, dict(overlay), last_out))
+                    if self.keep:
+                        self._write(file, self._COMPLETED)
+
+                if not self.keep:
+                    os.remove(self.path)
+                return last_out
+
+            def _fingerprint(self, graph):
+                keys = repr(list(self._traverse(graph)))
+                return hashlib.sha256(keys.encode()).hexdigest()
+
+            def _inputs_digest(self, graph, context):
+                """Digest of the values of the keys the graph reads before
+                writing them, None when they cannot be pickled."""
+                keys = graph._cached(
+                    (type(self), "inputs"), lambda: self._input_keys(graph)
+                )
+                if keys is None:
+                    keys = list(context)
+                values = [
+                    (repr(key), context[key])
+                    for key in sorted(keys, key=repr)
+                    if key in context
+                ]
+                try:
+                    payload = pickle.dumps(values, protocol=4)
+                except Exception:
+                    return None
+                return hashlib.sha256(payload).hexdigest()
+
+            def _input_keys(self, graph):
+                inputs = set()
+                written = set()
+                for obj in self.compile(graph):
+                    reads = _read_keys(obj)
+                    if reads is None:
+                        return None
+                    inputs |= reads - written
+                    written |= _write_keys(obj) or set()
+                return inputs
+
+            def _write(self, file, record):
+                try:
+                    payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                except Exception as exception:
+                    raise TypeError(
+                        f"Checkpoint record cannot be pickled: {exception}"
+                    ) from exception
+                file.write(self._HEADER.pack(len(payload)))
+                file.write(payload)
+                file.flush()
+                if self.sync:
+                    os.fsync(file.fileno())
+
+            def _load(self, header):
+                """Return the records of completed items and the size of the
+                readable part of the file (0 when it must be started over)."""
+                try:
+                    with open(self.path, "rb") as file:
+                        data = file.read()
+                except FileNotFoundError:
+                    return [], 0
+                frames = []
+                position = 0
+                while position + self._HEADER.size <= len(data):
+                    (size,) = self._HEADER.unpack_from(data, position)
+                    start = position + self._HEADER.size
+                    if start + size > len(data):  # cut off while writing
+                        break
+                    try:
+                        frames.append(
+                            (pickle.loads(data[start : start + size]), start + size)
+                        )
+                    except Exception:
+                        break
+                    position = start + size
+                if not frames or frames[0][0] != header or header[1] is None:
+                    return [], 0
+                records = []
+                valid_size = frames[0][1]
+                for record, end in frames[1:]:
+                    if record == self._COMPLETED:
+                        return [], 0
+                    if record[0] != len(records):
+                        break
+                    records.append(record)
+                    valid_size = end
+                return records, valid_size
+
+        class Incremental(Balanced):
+            """Re-executes only items whose inputs changed since the last run.
+
+            Every item runs against a recording overlay of the context, which
+            remembers the values it read and wrote. On the next call of the same
+            graph an item is skipped, and its previous writes are put back into
+            the context, when every value it read is still identical or equal.
+            Values modified in place are not detected. Records are dropped when
+            the structure of the graph changes.
+            """
+
+            def __init__(self):
+                self.executed = []
+                self.skipped = []
+
+            def __call__(self, graph, context):
+                plan = self.compile(graph)
+                keys = self._keys(graph)
+                records = graph._cached((type(self), "records"), dict)
+                executed = []
+                skipped = []
+                last_out = None
+                for index, obj in enumerate(plan):
+                    record = records.get(index)
+                    if record is not None and not self._changed(record[0], context):
+                        _, writes, last_out = record
+                        for key, value in writes.items():
+                            context[key] = value
+                        skipped.append(keys[index])
+                        continue
+                    records.pop(index, None)
+                    overlay = _RecordingContext(context)
+                    last_out = _call_item(keys[index], obj, overlay)
+                    overlay.merge()
+                    records[index] = (overlay.reads, dict(overlay), last_out)
+                    executed.append(keys[index])
+                self.executed = executed
+                self.skipped = skipped
+                return last_out
+
+            def invalidate(self, graph):
+                """Forget recorded runs, so the next call executes everything."""
+                graph._cached((type(self), "records"), dict).clear()
+
+            def _changed(self, reads, context):
+                for key, old in reads.items():
+                    if key not in context:
+                        return True
+                    new = context[key]
+                    if new is old:
+                        continue
+                    try:
+                        if new == old:
+                            continue
+                    except Exception:  # e.g. ambiguous truth value of arrays
+                        pass
+                    return True
+                return False
+
+        class MemorySaving(Balanced):
+            """Drops intermediate keys from the context once nothing reads them.
+
+            Reads and writes of items come from their KeyGetters and put_to
+            keys. A key written by the graph is released right after the last
+            item reading or writing it, unless it is listed in outputs; keys
+            the graph never writes (inputs) are kept. Items whose reads cannot
+            be told keep every key alive until they ran. With spill_dir given,
+            released values are pickled there (see load_spilled) instead of
+            being lost.
+            """
+
+            def __init__(self, outputs=(), spill_dir=None):
+                self.outputs = frozenset(outputs)
+                self.spill_dir = spill_dir
+                self.spilled = {}
+
+            def __call__(self, graph, context):
+                self.spilled = {}
+                last_out = None
+                plan = self.compile(graph)
+                for key, (obj, release) in zip(self._keys(graph), plan):
+                    last_out = _call_item(key, obj, context)
+                    for key in release:
+                        if key in context:
+                            self._release(context, key)
+                return last_out
+
+            def compile(self, graph):
+                return graph._cached(
+                    (type(self), "plan", self.outputs), lambda: self._compile(graph)
+                )
+
+            def _compile(self, graph):
+                plan = super()._compile(graph)
+                first_write = {}
+                last_use = {}
+                last_unknown = -1
+                for index, obj in enumerate(plan):
+                    reads = _read_keys(obj)
+                    if reads is None:
+                        last_unknown = index
+                        reads = ()
+                    for key in _write_keys(obj) or ():
+                        first_write.setdefault(key, index)
+                        last_use[key] = index
+                    for key in reads:
+                        last_use[key] = index
+
+                release = [[] for _ in plan]
+                for key, written in first_write.items():
+                    if key in self.outputs:
+                        continue
+                    index = last_use[key]
+                    if last_unknown > written:
+                        index = max(index, last_unknown)
+                    release[index].append(key)
+                return [(obj, tuple(keys)) for obj, keys in zip(plan, release)]
+
+            def _release(self, context, key):
+                value = context.pop(key)
+                if self.spill_dir is None:
+                    return
+                os.makedirs(self.spill_dir, exist_ok=True)
+                name = hashlib.sha256(repr(key).encode()).hexdigest() + ".pickle"
+                path = os.path.join(self.spill_dir, name)
+                with open(path, "wb") as file:
+                    pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+                self.spilled[key] = path
+
+            def load_spilled(self, key):
+                with open(self.spilled[key], "rb") as file:
+                    return pickle.load(file)
+
+        class Batched(Balanced):
+            """Runs the graph once over a BatchContext of many records.
+
+            Tasks declared vectorized get whole columns for their KeyGetters
+            and must return a column of the batch size; other Tasks are mapped
+            over the records. Both go through the Task protocol, except that
+            functions of BasicContext Tasks are mapped directly. Workflows and
+            nested graphs are run item by item the same way. Any other item is
+            called once per record. Items returning awaitables (e.g. with an
+            Async protocol) raise TypeError.
+            """
+
+            def __call__(self, graph, batch):
+                last_out = None
+                for obj in self.compile(graph):
+                    last_out = self._run_item(obj, batch)
+                return last_out
+
+            def _run_item(self, obj, batch):
+                if isinstance(obj, Task):
+                    return self._run_task(obj, batch)
+                if isinstance(obj, _Connector):
+                    return None
+                if isinstance(obj, WorkflowGraph):
+                    return self(obj, batch)
+                if isinstance(obj, Workflow):
+                    return self._run_workflow(obj, batch)
+                return self._run_records(obj, batch)
+
+            def _run_task(self, task, batch):
+                direct = type(task.protocol) is Protocols.TaskProtocols.BasicContext
+                if not direct and not task.vectorized:
+                    return self._run_records(task, batch)
+                if not direct:
+                    result = self._check_sync(task, task(batch))
+                elif task.vectorized:
+                    args, kwargs = batch.resolve_keys(task.signature)
+                    result = task.func(*args, **kwargs)
+                else:
+                    result = self._map_task(task, batch)
+                if task.vectorized and len(result) != batch.size:
+                    raise ValueError(
+                        f"Vectorized {task.func!r} returned {len(result)} values "
+                        f"for a batch of {batch.size}"
+                    )
+                if direct and task.put_to is not None:
+                    batch[task.put_to] = result
+                return result
+
+            def _check_sync(self, obj, out):
+                if inspect.isawaitable(out):
+                    if inspect.iscoroutine(out):
+                        out.close()
+                    raise TypeError(
+                        f"{obj!r} returned an awaitable, Batched runs items "
+                        "synchronously"
+                    )
+                return out
+
+            def _map_task(self, task, batch):
+                size = batch.size
+                signature = task.signature
+                columns = [
+                    self._column(parameter, batch, size)
+                    for parameter in (*signature.args, *signature.kwargs.values())
+                ]
+                if not columns:
+                    return [task.func() for _ in range(size)]
+                if not signature.kwargs:
+                    return list(map(task.func, *columns))
+                names = list(signature.kwargs)
+                split = len(signature.args)
+                return [
+                    task.func(*row[:split], **dict(zip(names, row[split:])))
+                    for row in zip(*columns)
+                ]
+
+            def _column(self, parameter, batch, size):
+                if isinstance(parameter, KeyGetter):
+                    return batch[parameter.key]
+                return repeat(parameter, size)
+
+            def _run_workflow(self, workflow, batch):
+                if not isinstance(
+                    workflow.protocol, Protocols.WorkflowProtocols.Sequential
+                ):
+                    last_out = None
+                    for item in workflow.items:
+                        last_out = self._run_item(item, batch)
+                    return last_out
+
+                if workflow.map_ctx:
+                    for k_from, k_to in workflow.map_ctx.items():
+                        batch[k_to] = batch[k_from]
+                for item in workflow.items:
+                    batch[workflow.put_to] = self._run_item(item, batch)
+                if workflow.return_key:
+                    return batch[workflow.return_key]
+
+            def _run_records(self, obj, batch):
+                rows = [_RowContext(batch, index) for index in range(batch.size)]
+                outs = [self._check_sync(obj, obj(row)) for row in rows]
+                written = dict.fromkeys(key for row in rows for key in row)
+                for key in written:
+                    batch[key] = [row[key] for row in rows]
+                return outs
+
+        class Async(Balanced):
+            """Starts every item as soon as its own predecessors finished.
+
+            Calling the protocol returns a coroutine. Awaitable results of items
+            are awaited; synchronous items run directly in the event loop. The
+            result is the one of the last item in topological order, and items
+            finishing together are handled in that order too.
+            """
+
+            def __init__(self, max_concurrency=None):
+                self.max_concurrency = max_concurrency
+
+            async def __call__(self, graph, context):
+                successors, pending, objs, rank = self.compile(graph)
+                pending = dict(pending)
+                ready = deque(key for key, count in pending.items() if count == 0)
+                running = {}
+                finished = 0
+                last_out = None
+                last_rank = -1
+                try:
+                    while ready or running:
+                        while ready and (
+                            self.max_concurrency is None
+                            or len(running) < self.max_concurrency
+                        ):
+                            key = ready.popleft()
+                            future = asyncio.ensure_future(
+                                self._run_item(key, objs[key], context)
+                            )
+                            running[future] = key
+                        done, _ = await asyncio.wait(
+                            running, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        for future in sorted(done, key=lambda f: rank[running[f]]):
+                            key = running.pop(future)
+                            out = future.result()
+                            if rank[key] > last_rank:
+                                last_out, last_rank = out, rank[key]
+                            finished += 1
+                            for successor in successors[key]:
+                                pending[successor] -= 1
+                                if pending[successor] == 0:
+                                    ready.append(successor)
+                finally:
+                    for future in running:
+                        future.cancel()
+                    if running:
+                        await asyncio.gather(*running, return_exceptions=True)
+
+                if finished < len(pending):
+                    blocked = [key for key, count in pending.items() if count > 0]
+                    raise ValueError(f"Graph items wait on each other: {blocked}")
+                return last_out
+
+            def _compile(self, graph):
+                successors, pending = self._get_dependencies(graph)
+                objs = {key: self._get_item(graph, key) for key in pending}
+                counts = dict(pending)
+                order = [key for key, count in counts.items() if count == 0]
+                for key in order:
+                    for successor in successors[key]:
+                        counts[successor] -= 1
+                        if counts[successor] == 0:
+                            order.append(successor)
+                rank = {key: index for index, key in enumerate(order)}
+                return successors, pending, objs, rank
+
+            async def _run_item(self, key, obj, context):
+                out = _call_item(key, obj, context)
+                if inspect.isawaitable(out):
+                    out = await out
+                return out
+
+
+class Task:
+    def __init__(
+        self,
+        func: TypingCallable,
+        signature: Signature,
+        put_to: str = None,
+        protocol=Protocols.TaskProtocols.BasicContext(),
+        vectorized: bool = False,
+        timeout: float = None,
+        idempotent: bool = False,
+        resource: str = None,
+        weight: float = 1,
+    ):
+        self.func = func
+        self.signature = signature
+        self.put_to = put_to
+        self.protocol = protocol
+        self.vectorized = vectorized
+        self.timeout = timeout
+        self.idempotent = idempotent
+        self.resource = resource
+        self.weight = weight
+
+    def __call__(self, context: Context) -> Any:
+        if instrumentation.observers:
+            return instrumentation.call(self, context)
+        return self.protocol(self, context)
+
+    def read_keys(self):
+        return set(self.signature.read_keys())
+
+    def write_keys(self):
+        return set() if self.put_to is None else {self.put_to}
+
+
+def _read_keys(obj):
+    """Context keys obj may read, None when that cannot be told."""
+    read_keys = getattr(obj, "read_keys", None)
+    return read_keys() if read_keys is not None else None
+
+
+def _write_keys(obj):
+    """Context keys obj may write, None when that cannot be told."""
+    write_keys = getattr(obj, "write_keys", None)
+    return write_keys() if write_keys is not None else None
+
+
+def _union(key_sets):
+    union = set()
+    for keys in key_sets:
+        if keys is None:
+            return None
+        union |= keys
+    return union
+
+
+class Workflow:
+    def __init__(self, items, protocol=None):
+        self.items = items
+        self.protocol = protocol
+
+    def __call__(self, context: Context):
+        if instrumentation.observers:
+            return instrumentation.call(self, context)
+        return self.protocol(self, context)
+
+    def read_keys(self):
+        return _union(_read_keys(item) for item in self.items)
+
+    def write_keys(self):
+        return _union(_write_keys(item) for item in self.items)
+
+
+class WorkflowWithAssumptions(Workflow):
+    def __init__(self, *args, put_to=None, map_ctx=None, return_key=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.put_to = put_to
+        self.map_ctx = map_ctx
+        self.return_key = return_key
+
+    def read_keys(self):
+        keys = super().read_keys()
+        if keys is not None:
+            keys |= set(self.map_ctx) if self.map_ctx else set()
+            keys |= {self.return_key} if self.return_key else set()
+        return keys
+
+    def write_keys(self):
+        keys = super().write_keys()
+        if keys is not None:
+            keys |= set(self.map_ctx.values()) if self.map_ctx else set()
+            keys |= set() if self.put_to is None else {self.put_to}
+        return keys
+
+
+class _TrackedDict(dict):
+    """dict counting its modifications, so structures derived from it can be
+    rebuilt only when needed."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.version += 1
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super().clear()
+        self.version += 1
+
+    def pop(self, *args):
+        self.version += 1
+        return super().pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.version += 1
+
+
+class GraphEngines:
+    class Dict:
+        """Keeps the adjacency of a WorkflowGraph as a dict of target lists.
+
+        Structures are built from graph.edges on first use and cached on the
+        graph until its nodes, edges or root_node change. Targets keep the
+        order in which edges were added.
+        """
+
+        def edge_dict(self, graph):
+            return graph._cached((type(self), "edge_dict"), lambda: self._build(graph))
+
+        def _build(self, graph):
+            edge_dict = {}
+            for src, tar in graph.edges.keys():
+                if src in edge_dict:
+                    edge_dict[src].append(tar)
+                else:
+                    edge_dict[src] = [tar]
+            return edge_dict
+
+        def successors(self, graph, node_key):
+            return list(self.edge_dict(graph).get(node_key, ()))
+
+        def out_degree(self, graph, node_key):
+            return len(self.edge_dict(graph).get(node_key, ()))
+
+        def in_degree(self, graph, node_key):
+            in_degrees = graph._cached(
+                (type(self), "in_degree"),
+                lambda: self._count(tar for _, tar in graph.edges.keys()),
+            )
+            return in_degrees.get(node_key, 0)
+
+        @staticmethod
+        def _count(keys):
+            counts = {}
+            for key in keys:
+                counts[key] = counts.get(key, 0) + 1
+            return counts
+
+        def levels(self, graph):
+            """Yield lists of keys: nodes, their outgoing edges, target nodes..."""
+            edge_dict = self.edge_dict(graph)
+
+            # dicts are used as ordered sets so levels are deterministic
+            node_keys = dict.fromkeys((graph.root_node,))
+
+            while node_keys:
+                edge_keys = {}
+                for src_node_key in node_keys:
+                    if src_node_key in edge_dict:
+                        for target_node_key in edge_dict[src_node_key]:
+                            edge_keys[(src_node_key, target_node_key)] = None
+                yield list(node_keys)
+
+                if not edge_keys:
+                    break
+                yield list(edge_keys)
+                node_keys = dict.fromkeys(edge_key[-1] for edge_key in edge_keys)
+
+        def reachable(self, graph, source=None):
+            """Return node keys reachable from source (root_node by default)."""
+            edge_dict = self.edge_dict(graph)
+            source = graph.root_node if source is None else source
+            seen = {source: None}
+            stack = [source]
+            while stack:
+                for tar in edge_dict.get(stack.pop(), ()):
+                    if tar not in seen:
+                        seen[tar] = None
+                        stack.append(tar)
+            return list(seen)
+
+        def topological_order(self, graph):
+            """Return all node keys, every one after its predecessors.
+
+            Raises ValueError when the edges form a cycle.
+            """
+            return graph._cached(
+                (type(self), "topological_order"), lambda: self._sort(graph)
+            )
+
+        def _sort(self, graph):
+            edge_dict = self.edge_dict(graph)
+            pending = dict.fromkeys(graph.nodes, 0)
+            for _, tar in graph.edges.keys():
+                pending[tar] = pending.get(tar, 0) + 1
+            for src in edge_dict:
+                pending.setdefault(src, 0)
+            order = [key for key, count in pending.items() if count == 0]
+            for key in order:
+                for tar in edge_dict.get(key, ()):
+                    pending[tar] -= 1
+                    if pending[tar] == 0:
+                        order.append(tar)
+            if len(order) < len(pending):
+                blocked = [key for key, count in pending.items() if count > 0]
+                raise ValueError(f"Graph edges form a cycle through: {blocked}")
+            return order
+
+    class Array(Dict):
+        """Keeps the adjacency as compressed sparse rows of interned node ids.
+
+        Node keys are mapped to consecutive integer ids (nodes first, then
+        keys only found in edges). Targets of all nodes are stored in one
+        array, the ones of node i in targets[offsets[i]:offsets[i + 1]], next
+        to arrays of in and out degrees, so traversals run over integers in
+        time linear in the size of the graph. edge_dict is still available
+        for protocols expecting it, built from the arrays when asked for.
+        """
+
+        Adjacency = namedtuple(
+            "Adjacency", ("keys", "ids", "offsets", "targets", "in_degrees")
+        )
+
+        def adjacency(self, graph):
+            return graph._cached((type(self), "adjacency"), lambda: self._intern(graph))
+
+        def _intern(self, graph):
+            keys = list(graph.nodes)
+            ids = {key: index for index, key in enumerate(keys)}
+            sources = array("i")
+            targets = array("i")
+            for edge_key in graph.edges.keys():
+                for key, ends in zip(edge_key, (sources, targets)):
+                    if key not in ids:
+                        ids[key] = len(keys)
+                        keys.append(key)
+                    ends.append(ids[key])
+
+            size = len(keys)
+            offsets = array("q", bytes(8 * (size + 1)))
+            in_degrees = array("i", bytes(4 * size))
+            for src, tar in zip(sources, targets):
+                offsets[src + 1] += 1
+                in_degrees[tar] += 1
+            for index in range(size):
+                offsets[index + 1] += offsets[index]
+
+            # counting sort by source, stable so edge order is kept
+            position = offsets[:-1]
+            rows = array("i", bytes(4 * len(targets)))
+            for src, tar in zip(sources, targets):
+                rows[position[src]] = tar
+                position[src] += 1
+            return self.Adjacency(keys, ids, offsets, rows, in_degrees)
+
+        def _build(self, graph):
+            keys, _, offsets, targets, _ = self.adjacency(graph)
+            return {
+                keys[index]: [
+                    keys[tar] for tar in targets[offsets[index] : offsets[index + 1]]
+                ]
+                for index in range(len(keys))
+                if offsets[index] < offsets[index + 1]
+            }
+
+        def successors(self, graph, node_key):
+            keys, ids, offsets, targets, _ = self.adjacency(graph)
+            index = ids.get(node_key)
+            if index is None:
+                return []
+            return [keys[tar] for tar in targets[offsets[index] : offsets[index + 1]]]
+
+        def out_degree(self, graph, node_key):
+            _, ids, offsets, _, _ = self.adjacency(graph)
+            index = ids.get(node_key)
+            return 0 if index is None else offsets[index + 1] - offsets[index]
+
+        def in_degree(self, graph, node_key):
+            _, ids, _, _, in_degrees = self.adjacency(graph)
+            index = ids.get(node_key)
+            return 0 if index is None else in_degrees[index]
+
+        def levels(self, graph):
+            keys, ids, offsets, targets, _ = self.adjacency(graph)
+            if graph.root_node not in ids:
+                yield [graph.root_node]
+                return
+            # level at which a node was last added, to keep every level a set
+            added = array("i", [-1]) * len(keys)
+            frontier = [ids[graph.root_node]]
+            level = 0
+            while True:
+                yield [keys[index] for index in frontier]
+                edge_keys = []
+                next_frontier = []
+                level += 1
+                for src in frontier:
+                    src_key = keys[src]
+                    for tar in targets[offsets[src] : offsets[src + 1]]:
+                        edge_keys.append((src_key, keys[tar]))
+                        if added[tar] != level:
+                            added[tar] = level
+                            next_frontier.append(tar)
+                if not edge_keys:
+                    break
+                yield edge_keys
+                frontier = next_frontier
+
+        def reachable(self, graph, source=None):
+            keys, ids, offsets, targets, _ = self.adjacency(graph)
+            source = graph.root_node if source is None else source
+            if source not in ids:
+                return [source]
+            seen = bytearray(len(keys))
+            start = ids[source]
+            seen[start] = 1
+            order = [start]
+            for src in order:
+                for tar in targets[offsets[src] : offsets[src + 1]]:
+                    if not seen[tar]:
+                        seen[tar] = 1
+                        order.append(tar)
+            return [keys[index] for index in order]
+
+        def _sort(self, graph):
+            keys, _, offsets, targets, in_degrees = self.adjacency(graph)
+            pending = array("i", in_degrees)
+            order = [index for index in range(len(keys)) if not pending[index]]
+            for src in order:
+                for tar in targets[offsets[src] : offsets[src + 1]]:
+                    pending[tar] -= 1
+                    if not pending[tar]:
+                        order.append(tar)
+            if len(order) < len(keys):
+                blocked = [keys[index] for index in range(len(keys)) if pending[index]]
+                raise ValueError(f"Graph edges form a cycle through: {blocked}")
+            return [keys[index] for index in order]
+
+
+class GraphReport(
+    namedtuple(
+        "GraphReport",
+        (
+            "cycle",
+            "unreachable",
+            "dangling_nodes",
+            "missing_nodes",
+            "dangling_edges",
+            "multi_depth",
+            "cycle_reachable",
+        ),
+    )
+):
+    """Result of WorkflowGraph.validate().
+
+    cycle is a path of node keys ending where it started, or None, and
+    cycle_reachable tells whether root_node reaches it. Nodes not reachable
+    from root_node, nodes without any edge and keys used by edges (or
+    root_node) but missing from nodes are listed, with the edges using them.
+    multi_depth lists nodes reachable from the root at several depths, which
+    Balanced runs once per depth.
+    """
+
+    __slots__ = ()
+
+    @property
+    def connected(self):
+        return not (
+            self.unreachable
+            or self.dangling_nodes
+            or self.missing_nodes
+            or self.dangling_edges
+        )
+
+
+class WorkflowGraph:
+    """Nodes connected by edges, run from root_node by protocol.
+
+    nodes and edges are copied into dicts that count their changes, so the
+    plans compiled from them are rebuilt only when needed. Change the graph
+    through graph.nodes and graph.edges: later changes of the dicts passed
+    in are not seen (unless they are the nodes or edges of another graph,
+    which are then shared).
+    """
+
+    def __init__(
+        self,
+        nodes: dict = None,
+        edges: dict = None,
+        root_node=None,
+        protocol=None,
+        engine=None,
+    ):
+        self._version = 0
+        self._cache = {}
+        self._cache_key = None
+        self.nodes = nodes if nodes else dict()
+        self.edges = edges if edges else dict()
+        self.root_node = root_node
+        self.protocol = protocol
+        self.engine = engine if engine is not None else GraphEngines.Dict()
+
+    @property
+    def nodes(self):
+        return self._nodes
+
+    @nodes.setter
+    def nodes(self, nodes):
+        self._nodes = nodes if isinstance(nodes, _TrackedDict) else _TrackedDict(nodes)
+        self._version += 1
+
+    @property
+    def edges(self):
+        return self._edges
+
+    @edges.setter
+    def edges(self, edges):
+        self._edges = edges if isinstance(edges, _TrackedDict) else _TrackedDict(edges)
+        self._version += 1
+
+    @property
+    def root_node(self):
+        return self._root_node
+
+    @root_node.setter
+    def root_node(self, root_node):
+        self._root_node = root_node
+        self._version += 1
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        self._engine = engine
+        self._version += 1
+
+    def __call__(self, context: Context):
+        if instrumentation.observers:
+            return instrumentation.call(self, context)
+        return self.protocol(self, context)
+
+    def traverse(self):
+        yield from self.protocol._traverse(self)
+
+    def read_keys(self):
+        return _union(
+            _read_keys(obj) for obj in (*self.nodes.values(), *self.edges.values())
+        )
+
+    def write_keys(self):
+        return _union(
+            _write_keys(obj) for obj in (*self.nodes.values(), *self.edges.values())
+        )
+
+    def validate(self):
+        """Check the structure of the graph in time linear in its size.
+
+        Returns a GraphReport, cached until nodes, edges or root_node change.
+        """
+        return self._cached("validate", self._validate)
+
+    def _validate(self):
+        nodes = self.nodes
+        engine = self.engine
+
+        def successors(key):
+            return engine.successors(self, key)
+
+        missing_nodes = {}
+        dangling_edges = []
+        linked = set()
+        for edge_key in self.edges.keys():
+            linked.update(edge_key)
+            for key in edge_key:
+                if key not in nodes:
+                    missing_nodes[key] = None
+            if edge_key[0] not in nodes or edge_key[-1] not in nodes:
+                dangling_edges.append(edge_key)
+        if self.root_node not in nodes:
+            missing_nodes[self.root_node] = None
+
+        reachable = self.engine.reachable(self)
+        reached = set(reachable)
+        unreachable = [key for key in nodes if key not in reached]
+        dangling_nodes = [
+            key for key in nodes if key not in linked and key != self.root_node
+        ]
+        cycle = self._find_cycle(successors, [*reachable, *unreachable, *missing_nodes])
+        cycle_reachable = cycle is not None and cycle[0] in reached
+        if cycle_reachable:
+            multi_depth = []
+        else:
+            multi_depth = self._multi_depth(successors, reached)
+        return GraphReport(
+            cycle,
+            unreachable,
+            dangling_nodes,
+            list(missing_nodes),
+            dangling_edges,
+            multi_depth,
+            cycle_reachable,
+        )
+
+    @staticmethod
+    def _find_cycle(successors, starts):
+        on_path = {}  # key: position in path, -1 once all its successors are done
+        for start in starts:
+            if start in on_path:
+                continue
+            on_path[start] = 0
+            path = [start]
+            iterators = [iter(successors(start))]
+            while iterators:
+                for tar in iterators[-1]:
+                    position = on_path.get(tar)
+                    if position is None:
+                        on_path[tar] = len(path)
+                        path.append(tar)
+                        iterators.append(iter(successors(tar)))
+                        break
+                    if position >= 0:
+                        return path[position:] + [tar]
+                else:
+                    on_path[path.pop()] = -1
+                    iterators.pop()
+        return None
+
+    def _multi_depth(self, successors, reached):
+        # a node gets several depths when its reachable predecessors disagree
+        # on its depth or one of them has several depths itself
+        pending = dict.fromkeys(reached, 0)
+        for src in reached:
+            for tar in successors(src):
+                pending[tar] += 1
+        depth = {self.root_node: 0}
+        multi = {}
+        order = [self.root_node]
+        for src in order:
+            for tar in successors(src):
+                tar_depth = depth[src] + 1
+                if src in multi or depth.get(tar, tar_depth) != tar_depth:
+                    multi[tar] = None
+                depth[tar] = min(depth.get(tar, tar_depth), tar_depth)
+                pending[tar] -= 1
+                if pending[tar] == 0:
+                    order.append(tar)
+        return list(multi)
+
+    def compile(self):
+        """Build (or reuse) the execution plan of the protocol for this graph.
+
+        Plans are cached on the graph and dropped whenever nodes, edges or
+        root_node change, so calling the graph again only iterates the plan.
+        """
+        return self.protocol.compile(self)
+
+    def _cached(self, name, build):
+        key = (self._version, self._nodes.version, self._edges.version)
+        if self._cache_key != key:
+            # a new dict, so a concurrent reader never sees a half cleared one
+            self._cache = {}
+            self._cache_key = key
+        cache = self._cache
+        if name not in cache:
+            cache[name] = build()
+        return cache[name]
+
+
+class _Connector:
+    """Graph item doing nothing, it only orders the items it connects."""
+
+    __slots__ = ()
+
+    def __call__(self, context):
+        return None
+
+    def read_keys(self):
+        return set()
+
+    def write_keys(self):
+        return set()
+
+
+class FusedTask:
+    """Runs a chain of Tasks as one graph item.
+
+    Values of the keys in private are passed between the Tasks in a local
+    overlay of the context and never written to it; other put_to keys are
+    written to the context as the Tasks would. Signatures are bound when the
+    FusedTask is made.
+    """
+
+    __slots__ = ("tasks", "private", "_steps")
+
+    def __init__(self, tasks, private=()):
+        self.tasks = list(tasks)
+        self.private = frozenset(private)
+        self._steps = [
+            (
+                task.signature.compile(),
+                task.func,
+                task.put_to,
+                task.put_to in self.private,
+            )
+            for task in self.tasks
+        ]
+
+    def __call__(self, context):
+        local = ScopedContext(context) if self.private else context
+        out = None
+        for bind, func, put_to, private in self._steps:
+            args, kwargs = bind(local)
+            out = func(*args, **kwargs)
+            if put_to is not None:
+                if private:
+                    local[put_to] = out
+                else:
+                    context[put_to] = out
+        return out
+
+    def read_keys(self):
+        keys = set()
+        written = set()
+        for task in self.tasks:
+            keys |= task.read_keys() - written
+            written |= task.write_keys()
+        return keys
+
+    def write_keys(self):
+        return {
+            task.put_to
+            for task in self.tasks
+            if task.put_to is not None and task.put_to not in self.private
+        }
+
+
+class DataflowBuilder:
+    """Builds a WorkflowGraph from Tasks wired by the keys they read and write.
+
+    A Task depends on the Tasks producing (put_to) the keys it reads through
+    KeyGetters; keys listed in inputs are expected in the context, also when
+    a Task reads the key it writes itself. Tasks become
+    nodes placed on the earliest level their dependencies allow, connected by
+    edges doing nothing. Dependencies spanning several levels go through relay
+    nodes, so level by level protocols never run a Task too early and
+    dependency driven protocols see every dependency.
+    """
+
+    def __init__(self, inputs=(), root_node="root"):
+        self.inputs = set(inputs)
+        self.root_node = root_node
+
+    def build(self, tasks, protocol=None):
+        tasks = list(tasks)
+        node_keys = [self._node_key(index, task) for index, task in enumerate(tasks)]
+        dependencies = self._get_dependencies(tasks, node_keys)
+        order = self._sort(dependencies, node_keys)
+
+        return self._layout(tasks, node_keys, dependencies, order, protocol)
+
+    def _layout(self, tasks, node_keys, dependencies, order, protocol):
+        levels = {}
+        for index in order:
+            levels[index] = 1 + max(
+                (levels[dep] for dep in dependencies[index]), default=0
+            )
+
+        graph = WorkflowGraph(root_node=self.root_node, protocol=protocol)
+        nodes = {self.root_node: _Connector()}
+        edges = {}
+        for index in order:
+            if node_keys[index] in nodes:
+                raise ValueError(f"Node key {node_keys[index]!r} is used twice")
+            nodes[node_keys[index]] = tasks[index]
+            if not dependencies[index]:
+                edges[(self.root_node, node_keys[index])] = _Connector()
+            for dep in dependencies[index]:
+                src = node_keys[dep]
+                for level in range(levels[dep] + 1, levels[index]):
+                    relay = f"{node_keys[dep]}@{level}"
+                    if relay not in nodes:
+                        nodes[relay] = _Connector()
+                        edges[(src, relay)] = _Connector()
+                    src = relay
+                edges[(src, node_keys[index])] = _Connector()
+        graph.nodes = nodes
+        graph.edges = edges
+        return graph
+
+    def _node_key(self, index, task):
+        if task.put_to is None or isinstance(task.put_to, tuple):
+            return f"task_{index}"
+        return task.put_to
+
+    def _get_dependencies(self, tasks, node_keys):
+        producers = {}
+        for index, task in enumerate(tasks):
+            if task.put_to is None:
+                continue
+            if task.put_to in producers:
+                raise ValueError(f"Key {task.put_to!r} is produced by several Tasks")
+            producers[task.put_to] = index
+
+        dependencies = []
+        missing = {}
+        for index, task in enumerate(tasks):
+            deps = {}
+            for key in task.signature.read_keys():
+                if key in producers and producers[key] != index:
+                    deps[producers[key]] = None
+                elif key not in self.inputs:
+                    missing.setdefault(key, []).append(node_keys[index])
+            dependencies.append(list(deps))
+        if missing:
+            raise ValueError(f"No Task produces keys read by Tasks: {missing}")
+        return dependencies
+
+    def _sort(self, dependencies, node_keys):
+        pending = [len(deps) for deps in dependencies]
+        dependents = [[] for _ in dependencies]
+        for index, deps in enumerate(dependencies):
+            for dep in deps:
+                dependents[dep].append(index)
+
+        order = [index for index, count in enumerate(pending) if count == 0]
+        for index in order:
+            for dependent in dependents[index]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    order.append(dependent)
+
+        if len(order) < len(dependencies):
+            cycle = self._find_cycle(dependencies, pending)
+            path = " -> ".join(repr(node_keys[index]) for index in cycle)
+            raise ValueError(f"Tasks depend on each other in a cycle: {path}")
+        return order
+
+    def _find_cycle(self, dependencies, pending):
+        # every Task left pending waits on another pending one, so walking the
+        # pending dependencies must eventually come back to a visited Task
+        index = next(index for index, count in enumerate(pending) if count)
+        seen = {}
+        while index not in seen:
+            seen[index] = len(seen)
+            index = next(dep for dep in dependencies[index] if pending[dep])
+        path = list(seen)[seen[index] :]
+        return path + [index]
+
+
+class GraphInliner(DataflowBuilder):
+    """Flattens nested Workflows and WorkflowGraphs into one WorkflowGraph.
+
+    Workflows with the BasicContext protocol and WorkflowGraphs with the
+    Balanced protocol are replaced by the items they would run, in the order
+    they would run them; other objects are kept as they are. Each item then
+    depends on the earlier items writing keys it reads, reading keys it
+    writes or writing the same keys, and on every earlier item when its keys
+    cannot be told. Items are laid out like DataflowBuilder does, so any
+    protocol can run items of different nesting levels side by side, and the
+    last item still runs last and gives the result. Items are expected to
+    interact only through the context.
+
+    Node keys are paths of the original keys ("src->tar" for edges, indices
+    for Workflow items) joined with "/"; origins maps them to the path tuples.
+    """
+
+    def __init__(self, root_node="<root>"):
+        super().__init__(root_node=root_node)
+        self.origins = {}
+
+    def build(self, obj, protocol=None):
+        leaves = []
+        self._expand(obj, (), leaves)
+        items = [item for _, item in leaves]
+        node_keys = []
+        origins = {}
+        seen = {}
+        for path, _ in leaves:
+            key = "/".join(self._label(step) for step in path) or "item"
+            seen[key] = seen.get(key, 0) + 1
+            if seen[key] > 1:  # items run several times by Balanced
+                key = f"{key}#{seen[key]}"
+            node_keys.append(key)
+            origins[key] = path
+        self.origins = origins
+        dependencies = self._get_dependencies(items, node_keys)
+        return self._layout(items, node_keys, dependencies, range(len(items)), protocol)
+
+    def _expand(self, obj, path, leaves):
+        if (
+            isinstance(obj, Workflow)
+            and type(obj.protocol) is Protocols.WorkflowProtocols.BasicContext
+        ):
+            for index, item in enumerate(obj.items):
+                self._expand(item, path + (index,), leaves)
+        elif (
+            isinstance(obj, WorkflowGraph)
+            and type(obj.protocol) is Protocols.WorkflowGraphProtocols.Balanced
+        ):
+            for key in obj.protocol._traverse(obj):
+                self._expand(obj.protocol._get_item(obj, key), path + (key,), leaves)
+        else:
+            leaves.append((path, obj))
+
+    @staticmethod
+    def _label(step):
+        if isinstance(step, tuple):
+            return "->".join(map(str, step))
+        return str(step)
+
+    def _get_dependencies(self, items, node_keys):
+        last_writer = {}
+        readers = {}
+        # items nothing depends on yet
+        open_items = {}
+        barrier = None
+        dependencies = []
+        for index, item in enumerate(items):
+            read_keys = _read_keys(item)
+            write_keys = _write_keys(item)
+            if read_keys is None or write_keys is None:
+                deps = dict(open_items)
+                last_writer = {}
+                readers = {}
+                barrier = index
+            else:
+                deps = {} if barrier is None else {barrier: None}
+                for key in read_keys:
+                    if key in last_writer:
+                        deps[last_writer[key]] = None
+                for key in write_keys:
+                    if key in last_writer:
+                        deps[last_writer[key]] = None
+                    deps.update(dict.fromkeys(readers.get(key, ())))
+                for key in read_keys:
+                    readers.setdefault(key, []).append(index)
+                for key in write_keys:
+                    last_writer[key] = index
+                    readers[key] = []
+            deps.pop(index, None)
+            for dep in deps:
+                open_items.pop(dep, None)
+            open_items[index] = None
+            dependencies.append(list(deps))
+        if items:
+            # the last item gives the result, so it has to run last
+            deps = dict.fromkeys(dependencies[-1])
+            deps.update(open_items)
+            deps.pop(len(items) - 1)
+            dependencies[-1] = list(deps)
+        return dependencies
+
+
+class TaskFuser:
+    """Merges chains of Tasks into FusedTasks.
+
+    Chains are runs of consecutive Tasks in Workflows with the BasicContext
+    protocol, and paths through WorkflowGraphs (run by Balanced, Parallel,
+    CriticalPath or Async) where a node has one outgoing edge or an edge
+    leads to a node with one incoming edge. Only Tasks with the
+    BasicContext protocol that are not vectorized are fused. In graphs the
+    FusedTask takes the place of the last item of its chain and the others
+    are replaced by items doing nothing, so a chain is cut after an item
+    that could read or leave different values when run that late. Keys
+    written in a chain, except by its last Task, become private when they
+    are written and read nowhere else and are not listed in outputs.
+
+    fuse returns a fused copy, nested Workflows and WorkflowGraphs included;
+    all keys must be known (read_keys and write_keys) for keys to become
+    private or graph chains to be fused.
+    """
+
+    _graph_protocols = (
+        Protocols.WorkflowGraphProtocols.Balanced,
+        Protocols.WorkflowGraphProtocols.Parallel,
+        Protocols.WorkflowGraphProtocols.CriticalPath,
+        Protocols.WorkflowGraphProtocols.Async,
+    )
+
+    def __init__(self, outputs=()):
+        self.outputs = set(outputs)
+
+    def fuse(self, obj):
+        self._readers = {}
+        self._writers = {}
+        self._unknown = False
+        self._collect(obj, ())
+        return self._fuse(obj, ())
+
+    def _children(self, obj):
+        if (
+            isinstance(obj, Workflow)
+            and type(obj.protocol) is Protocols.WorkflowProtocols.BasicContext
+        ):
+            return list(enumerate(obj.items))
+        if (
+            isinstance(obj, WorkflowGraph)
+            and type(obj.protocol) in self._graph_protocols
+        ):
+            return [*obj.nodes.items(), *obj.edges.items()]
+        return None
+
+    @staticmethod
+    def _fusible(obj):
+        return (
+            isinstance(obj, Task)
+            and type(obj.protocol) is Protocols.TaskProtocols.BasicContext
+            and not obj.vectorized
+        )
+
+    def _collect(self, obj, path):
+        children = self._children(obj)
+        if children is not None:
+            for step, child in children:
+                self._collect(child, path + (step,))
+            return
+        read_keys = _read_keys(obj)
+        write_keys = _write_keys(obj)
+        if read_keys is None or write_keys is None:
+            self._unknown = True
+            return
+        for key in read_keys:
+            self._readers.setdefault(key, set()).add(path)
+        for key in write_keys:
+            self._writers.setdefault(key, set()).add(path)
+
+    def _fuse(self, obj, path):
+        if self._children(obj) is None:
+            return obj
+        if isinstance(obj, Workflow):
+            fused = copy.copy(obj)
+            fused.items = self._fuse_items(obj.items, path)
+            return fused
+        nodes = {
+            key: self._fuse(item, path + (key,)) for key, item in obj.nodes.items()
+        }
+        edges = {
+            key: self._fuse(item, path + (key,)) for key, item in obj.edges.items()
+        }
+        if not self._unknown and obj.validate().cycle is None:
+            self._fuse_chains(obj, path, nodes, edges)
+        return WorkflowGraph(nodes, edges, obj.root_node, obj.protocol, obj.engine)
+
+    def _fuse_items(self, items, path):
+        fused = []
+        run = []
+        for index, item in enumerate(items):
+            if self._fusible(item):
+                run.append((path + (index,), item))
+                continue
+            fused.extend(self._fuse_run(run))
+            run = []
+            fused.append(self._fuse(item, path + (index,)))
+        fused.extend(self._fuse_run(run))
+        return fused
+
+    def _fuse_run(self, run):
+        if len(run) < 2:
+            return [task for _, task in run]
+        return [FusedTask([task for _, task in run], self._private(run))]
+
+    def _private(self, run):
+        if self._unknown:
+            return set()
+        paths = {path for path, _ in run}
+        keys = set()
+        for _, task in run[:-1]:
+            keys |= task.write_keys()
+        keys.discard(run[-1][1].put_to)
+        return {
+            key
+            for key in keys - self.outputs
+            if self._readers.get(key, set()) <= paths and self._writers[key] <= paths
+        }
+
+    def _fuse_chains(self, graph, path, nodes, edges):
+        edge_dict = graph.engine.edge_dict(graph)
+        links = {}
+        for key, item in (*nodes.items(), *edges.items()):
+            if not self._fusible(item):
+                continue
+            if isinstance(key, tuple):
+                tar = key[-1]
+                if (
+                    tar != graph.root_node
+                    and self._fusible(nodes.get(tar))
+                    and graph.engine.in_degree(graph, tar) == 1
+                ):
+                    links[key] = tar
+            else:
+                targets = edge_dict.get(key, ())
+                if len(targets) == 1 and self._fusible(edges[(key, targets[0])]):
+                    links[key] = (key, targets[0])
+        linked = set(links.values())
+        heads = [
+            key
+            for key, item in (*nodes.items(), *edges.items())
+            if self._fusible(item) and key not in linked
+        ]
+        for head in heads:
+            chain = [head]
+            while chain[-1] in links:
+                chain.append(links[chain[-1]])
+            for segment in self._segments(graph, path, chain):
+                if len(segment) < 2:
+                    continue
+                run = []
+                for key in segment:
+                    items = edges if isinstance(key, tuple) else nodes
+                    run.append((path + (key,), items[key]))
+                    items[key] = _Connector()
+                items[segment[-1]] = FusedTask(
+                    [task for _, task in run], self._private(run)
+                )
+
+    def _segments(self, graph, path, chain):
+        """Split chain after every item that cannot run at the end of it."""
+        members = set(chain)
+        ancestors = None
+        segments = [[]]
+        for key in chain[:-1]:
+            segments[-1].append(key)
+            task = graph.edges[key] if isinstance(key, tuple) else graph.nodes[key]
+            deferrable = True
+            for written in task.write_keys():
+                writers = self._local(self._writers.get(written, ()), path)
+                readers = self._local(self._readers.get(written, ()), path)
+                if writers != {key} or not readers <= members:
+                    deferrable = False
+            for read in task.read_keys():
+                writers = self._local(self._writers.get(read, ()), path) - members
+                if writers:
+                    if ancestors is None:
+                        ancestors = self._ancestors(graph, chain[0])
+                    if not writers <= ancestors:
+                        deferrable = False
+            if not deferrable:
+                segments.append([])
+        segments[-1].append(chain[-1])
+        return segments
+
+    @staticmethod
+    def _local(paths, path):
+        """Keys of the graph items at path the paths belong to."""
+        depth = len(path)
+        return {
+            item_path[depth]
+            for item_path in paths
+            if len(item_path) > depth and item_path[:depth] == path
+        }
+
+    @staticmethod
+    def _ancestors(graph, key):
+        incoming = {}
+        for edge_key in graph.edges:
+            incoming.setdefault(edge_key[-1], []).append(edge_key)
+        ancestors = set()
+        stack = [key]
+        while stack:
+            key = stack.pop()
+            previous = [key[0]] if isinstance(key, tuple) else incoming.get(key, ())
+            for item_key in previous:
+                if item_key not in ancestors:
+                    ancestors.add(item_key)
+                    stack.append(item_key)
+        return ancestors
+
+
+def _import_path(path):
+    """Return the object at path, "package.module:qualname" or
+    "package.module.name"."""
+    if ":" in path:
+        module_name, _, qualname = path.partition(":")
+    else:
+        module_name, _, qualname = path.rpartition(".")
+    if not module_name or not qualname:
+        raise ValueError(f"Not an import path: {path!r}")
+    obj = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _func_path(func):
+    """Return "module:qualname" of func if it imports back to func, else None."""
+    if isinstance(func, _LazyCallable):
+        try:
+            func = func._load()
+        except (ImportError, AttributeError, ValueError):
+            return None
+    module = getattr(func, "__module__", None)
+    qualname = getattr(func, "__qualname__", None)
+    if module is None or qualname is None:
+        return None
+    path = f"{module}:{qualname}"
+    try:
+        found = _import_path(path)
+    except (ImportError, AttributeError, ValueError):
+        return None
+    return path if found is func else None
+
+
+class _LazyCallable:
+    """Stands for the function at an import path, imported on the first call."""
+
+    __slots__ = ("path", "_func")
+
+    def __init__(self, path):
+        self.path = path
+        self._func = None
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def _load(self):
+        func = self._func
+        if func is None:
+            func = self._func = _import_path(self.path)
+        return func
+
+    def __reduce__(self):
+        return _LazyCallable, (self.path,)
+
+    def __repr__(self):
+        return f"<lazy {self.path}>"
+
+
+class GraphDefinition:
+    """Reads and writes Tasks, Workflows and WorkflowGraphs as plain data.
+
+    Objects become dicts with a "type" (Task, Workflow,
+    WorkflowWithAssumptions or WorkflowGraph); functions are import paths
+    ("module:qualname"), KeyGetters {"key": ...} and literal dicts among
+    arguments {"value": ...}. Protocols and engines are given by name, or by
+    a dict with a "type" and the arguments of the protocol; names not found
+    among Protocols are import paths. Edges are a list of {"src", "tar",
+    "item"} dicts. A dict with "func" and no "type" is a Task.
+
+    With lazy set, functions are imported when a Task runs for the first
+    time. load reads .json and .toml files (dump writes JSON). With
+    plan_cache set, load stores the levels of a Balanced (or derived) graph
+    next to the file and reuses them while the file is unchanged.
+    """
+
+    _TASK_DEFAULTS = (
+        ("vectorized", False),
+        ("timeout", None),
+        ("idempotent", False),
+        ("resource", None),
+        ("weight", 1),
+    )
+
+    def __init__(self, lazy=True, plan_cache=True):
+        self.lazy = lazy
+        self.plan_cache = plan_cache
+
+    def load(self, path):
+        with open(path, "rb") as file:
+            data = file.read()
+        if str(path).endswith(".toml"):
+            try:
+                import tomllib
+            except ImportError:  # Python < 3.11
+                import tomli as tomllib
+            obj = self.from_dict(tomllib.loads(data.decode()))
+        else:
+            obj = self.from_dict(json.loads(data))
+        if self.plan_cache and isinstance(obj, WorkflowGraph):
+            self._use_plan_cache(
+                obj, f"{path}.plan.json", hashlib.sha256(data).hexdigest()
+            )
+        return obj
+
+    def dump(self, obj, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(obj), file, indent=2)
+
+    def from_dict(self, data):
+        kind = data.get("type", "Task" if "func" in data else None)
+        if kind == "Task":
+            return Task(
+                self._load_func(data["func"]),
+                Signature(
+                    *map(self._load_argument, data.get("args", ())),
+                    **{
+                        name: self._load_argument(value)
+                        for name, value in data.get("kwargs", {}).items()
+                    },
+                ),
+                data.get("put_to"),
+                self._load_protocol(
+                    data.get("protocol", "BasicContext"), Protocols.TaskProtocols
+                ),
+                data.get("vectorized", False),
+                data.get("timeout"),
+                data.get("idempotent", False),
+                data.get("resource"),
+                data.get("weight", 1),
+            )
+        if kind in ("Workflow", "WorkflowWithAssumptions"):
+            items = [self.from_dict(item) for item in data.get("items", ())]
+            protocol = self._load_protocol(
+                data.get("protocol"), Protocols.WorkflowProtocols
+            )
+            if kind == "Workflow":
+                return Workflow(items, protocol)
+            return WorkflowWithAssumptions(
+                items,
+                protocol,
+                put_to=data.get("put_to"),
+                map_ctx=data.get("map_ctx"),
+                return_key=data.get("return_key"),
+            )
+        if kind == "WorkflowGraph":
+            engine = data.get("engine")
+            return WorkflowGraph(
+                nodes={
+                    key: self.from_dict(item)
+                    for key, item in data.get("nodes", {}).items()
+                },
+                edges={
+                    (edge["src"], edge["tar"]): self.from_dict(edge["item"])
+                    for edge in data.get("edges", ())
+                },
+                root_node=data.get("root_node"),
+                protocol=self._load_protocol(
+                    data.get("protocol"), Protocols.WorkflowGraphProtocols
+                ),
+                engine=(
+                    None
+                    if engine is None
+                    else self._load_protocol(engine, GraphEngines)
+                ),
+            )
+        raise ValueError(f"Unknown type of graph item: {kind!r}")
+
+    def to_dict(self, obj):
+        if isinstance(obj, Task):
+            data = {"type": "Task", "func": self._dump_func(obj.func)}
+            if obj.signature.args:
+                data["args"] = [self._dump_argument(arg) for arg in obj.signature.args]
+            if obj.signature.kwargs:
+                data["kwargs"] = {
+                    name: self._dump_argument(value)
+                    for name, value in obj.signature.kwargs.items()
+                }
+            if obj.put_to is not None:
+                data["put_to"] = obj.put_to
+            protocol = self._dump_protocol(obj.protocol, Protocols.TaskProtocols)
+            if protocol != "BasicContext":
+                data["protocol"] = protocol
+            for name, default in self._TASK_DEFAULTS:
+                value = getattr(obj, name)
+                if value is not default and value != default:
+                    data[name] = value
+            return data
+        if isinstance(obj, Workflow):
+            data = {
+                "type": type(obj).__name__,
+                "items": [self.to_dict(item) for item in obj.items],
+            }
+            if isinstance(obj, WorkflowWithAssumptions):
+                for name in ("put_to", "map_ctx", "return_key"):
+                    if getattr(obj, name) is not None:
+                        data[name] = getattr(obj, name)
+        elif isinstance(obj, WorkflowGraph):
+            for key in obj.nodes:
+                if not isinstance(key, str):
+                    raise ValueError(f"Node key {key!r} is not a string")
+            data = {
+                "type": "WorkflowGraph",
+                "root_node": obj.root_node,
+                "nodes": {key: self.to_dict(item) for key, item in obj.nodes.items()},
+                "edges": [
+                    {"src": src, "tar": tar, "item": self.to_dict(item)}
+                    for (src, tar), item in obj.edges.items()
+                ],
+            }
+            if type(obj.engine) is not GraphEngines.Dict:
+                data["engine"] = self._dump_protocol(obj.engine, GraphEngines)
+        else:
+            raise ValueError(f"{obj!r} cannot be written as a graph item")
+        if obj.protocol is not None:
+            data["protocol"] = self._dump_protocol(obj.protocol, self._namespace(obj))
+        return data
+
+    @staticmethod
+    def _namespace(obj):
+        if isinstance(obj, Workflow):
+            return Protocols.WorkflowProtocols
+        return Protocols.WorkflowGraphProtocols
+
+    def _load_func(self, path):
+        return _LazyCallable(path) if self.lazy else _import_path(path)
+
+    def _dump_func(self, func):
+        if isinstance(func, _LazyCallable):
+            return func.path
+        path = _func_path(func)
+        if path is None:
+            raise ValueError(f"{func!r} cannot be referenced by an import path")
+        return path
+
+    def _load_argument(self, value):
+        if isinstance(value, dict):
+            if set(value) == {"key"}:
+                return KeyGetter(value["key"])
+            if set(value) == {"value"}:
+                return value["value"]
+            raise ValueError(f"Argument {value!r} is neither a key nor a value")
+        return value
+
+    def _dump_argument(self, value):
+        if isinstance(value, KeyGetter):
+            return {"key": value.key}
+        if isinstance(value, dict):
+            return {"value": value}
+        return value
+
+    def _load_protocol(self, spec, namespace):
+        if spec is None:
+            return None
+        if isinstance(spec, str):
+            spec = {"type": spec}
+        options = dict(spec)
+        name = options.pop("type")
+        cls = getattr(namespace, name, None)
+        if cls is None:
+            cls = _import_path(name)
+        return cls(**options)
+
+    def _dump_protocol(self, protocol, namespace):
+        cls = type(protocol)
+        if getattr(namespace, cls.__name__, None) is cls:
+            name = cls.__name__
+        else:
+            name = f"{cls.__module__}:{cls.__qualname__}"
+        options = {}
+        if cls.__init__ is not object.__init__:
+            for parameter in inspect.signature(cls.__init__).parameters.values():
+                if parameter.name == "self" or parameter.kind in (
+                    parameter.VAR_POSITIONAL,
+                    parameter.VAR_KEYWORD,
+                ):
+                    continue
+                value = getattr(protocol, parameter.name, parameter.default)
+                if value is parameter.default:
+                    continue
+                value = self._plain(value)
+                if value == self._plain(parameter.default):
+                    continue
+                if not self._is_plain(value):
+                    raise ValueError(
+                        f"Argument {parameter.name}={value!r} of {name} "
+                        "cannot be written"
+                    )
+                options[parameter.name] = value
+        return {"type": name, **options} if options else name
+
+    def _plain(self, value):
+        """Write sets as sorted lists and tuples as lists."""
+        if isinstance(value, (set, frozenset)):
+            try:
+                return sorted(value)
+            except TypeError:
+                return sorted(value, key=repr)
+        if isinstance(value, tuple):
+            return list(value)
+        return value
+
+    def _is_plain(self, value):
+        if isinstance(value, (list, tuple)):
+            return all(map(self._is_plain, value))
+        if isinstance(value, dict):
+            return all(
+                isinstance(key, str) and self._is_plain(item)
+                for key, item in value.items()
+            )
+        return value is None or isinstance(value, (bool, int, float, str))
+
+    def _use_plan_cache(self, graph, path, digest):
+        if not isinstance(graph.protocol, Protocols.WorkflowGraphProtocols.Balanced):
+            return
+        try:
+            with open(path) as file:
+                cached = json.load(file)
+        except (OSError, ValueError):
+            cached = None
+        if cached is not None and cached.get("digest") == digest:
+            levels = [
+                [tuple(key) if isinstance(key, list) else key for key in level]
+                for level in cached["levels"]
+            ]
+            graph._cached("levels", lambda: levels)
+            return
+        try:
+            levels = graph.protocol._levels(graph)
+        except ValueError:
+            return  # reported when the graph runs
+        try:
+            with open(path, "w") as file:
+                json.dump({"digest": digest, "levels": levels}, file)
+        except OSError:
+            pass
+
+
+def _run_graph(graph, context):
+    out = graph(context)
+    if inspect.iscoroutine(out):  # e.g. the Async protocol
+        out = asyncio.run(out)
+    return out
+
+
+_worker_graph = None
+
+
+def _init_runner_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _run_in_runner_worker(context):
+    return _run_graph(_worker_graph, context), context
+
+
+class GraphRunner:
+    """Runs one WorkflowGraph for many contexts concurrently.
+
+    The plan of the graph is compiled before the first run and only read by
+    the runs, which share the graph. Its protocols therefore must not keep
+    state between calls (Incremental, Checkpointed and CriticalPath do).
+    Runs use a thread pool, or with processes set a process pool whose
+    workers receive the compiled graph once; contexts and results then have
+    to be picklable and contexts are updated with what the worker wrote.
+    A given executor is used as it is, with the graph sent along every run.
+    dicts are copied into Contexts.
+
+    At most max_pending runs (twice the number of workers by default) are
+    submitted at a time, the next context is taken from the iterable when a
+    run finished. stats() reports runs per second of the time in which runs
+    were in progress; time the consumer spends between results is not counted.
+    """
+
+    def __init__(
+        self,
+        graph,
+        max_workers=None,
+        processes=False,
+        executor=None,
+        max_pending=None,
+        mp_context=None,
+    ):
+        self.graph = graph
+        self.max_workers = max_workers
+        self.processes = processes
+        self.executor = executor
+        self.max_pending = max_pending
+        self.mp_context = mp_context
+        self.runs = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self._own_executor = None
+        self._lock = threading.Lock()
+        self._in_progress = 0
+        self._busy_since = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._own_executor is not None:
+            self._own_executor.shutdown()
+            self._own_executor = None
+
+    def map(self, contexts):
+        """Yield the results of runs in the order of contexts."""
+        return self._stream(contexts, ordered=True)
+
+    def as_completed(self, contexts):
+        """Yield (index of the context, result) as runs finish."""
+        return self._stream(contexts, ordered=False)
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "seconds": self.seconds,
+            "runs_per_second": self.runs / self.seconds if self.seconds else 0.0,
+        }
+
+    def _get_executor(self):
+        if self.executor is not None:
+            return self.executor
+        if self._own_executor is None:
+            if self.processes:
+                self._own_executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=self.mp_context,
+                    initializer=_init_runner_worker,
+                    initargs=(self.graph,),
+                )
+            else:
+                self._own_executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._own_executor
+
+    def _stream(self, contexts, ordered):
+        self.graph.compile()
+        executor = self._get_executor()
+        max_pending = self.max_pending or 2 * getattr(
+            executor, "_max_workers", os.cpu_count() or 1
+        )
+        contexts = iter(contexts)
+        running = {}
+        submitted = deque()
+        try:
+            for index, context in enumerate(contexts):
+                while len(running) >= max_pending:
+                    yield from self._collect(running, submitted, ordered)
+                if not isinstance(context, Context):
+                    context = Context(context)
+                self._started()
+                future = self._submit(executor, context)
+                future.add_done_callback(self._stopped)
+                running[future] = (index, context)
+                if ordered:
+                    submitted.append(future)
+            while running:
+                yield from self._collect(running, submitted, ordered)
+        finally:
+            for future in running:
+                future.cancel()
+
+    def _collect(self, running, submitted, ordered):
+        if ordered:
+            future = submitted.popleft()
+            wait((future,))
+            done = (future,)
+        else:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, context = running.pop(future)
+            out = self._finish(future, context)
+            yield out if ordered else (index, out)
+
+    def _remote(self):
+        return self.processes and self.executor is None
+
+    def _started(self):
+        with self._lock:
+            if self._in_progress == 0:
+                self._busy_since = time.perf_counter()
+            self._in_progress += 1
+
+    def _stopped(self, future):
+        with self._lock:
+            self._in_progress -= 1
+            if self._in_progress == 0:
+                self.seconds += time.perf_counter() - self._busy_since
+
+    def _submit(self, executor, context):
+        if self._remote():
+            return executor.submit(_run_in_runner_worker, context)
+        return executor.submit(_run_graph, self.graph, context)
+
+    def _finish(self, future, context):
+        try:
+            out = future.result()
+        except BaseException:
+            self.errors += 1
+            raise
+        self.runs += 1
+        if self._remote():
+            out, written = out
+            context.update(written)
+        return out
+
+
+def _dump_outcome(ok, value):
+    try:
+        return ok, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as exception:
+        error = RuntimeError(f"Result cannot be sent back: {exception!r}")
+        if not ok:
+            error = RuntimeError(repr(value))
+        return False, pickle.dumps(error)
+
+
+def run_worker(address, authkey, heartbeat=1.0):
+    """Serve calls of a Coordinator at address until it stops or goes away.
+
+    Start it in a process on any host that can import the called functions.
+    A heartbeat is sent every heartbeat seconds, also while a call runs.
+    """
+    conn = Client(address, authkey=authkey)
+    conn.send(("hello", os.getpid()))
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(heartbeat):
+            try:
+                with lock:
+                    conn.send(("heartbeat",))
+            except OSError:
+                return
+
+    threading.Thread(target=beat, daemon=True).start()
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+            if message[0] == "stop":
+                return
+            _, job, blob = message
+            try:
+                func, args, kwargs = pickle.loads(blob)
+                outcome = _dump_outcome(True, func(*args, **kwargs))
+            except Exception as exception:
+                outcome = _dump_outcome(False, exception)
+            try:
+                with lock:
+                    conn.send(("result", job, *outcome))
+            except OSError:
+                return
+    finally:
+        stopped.set()
+        conn.close()
+
+
+class _Worker:
+    __slots__ = ("conn", "job", "seen", "alive", "pid")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.job = None
+        self.seen = time.monotonic()
+        self.alive = True
+        self.pid = None
+
+    def hang_up(self):
+        """Ask the worker to stop and wake up the thread reading from it."""
+        try:
+            self.conn.send(("stop",))
+        except OSError:
+            pass
+        try:
+            sock = socket.socket(fileno=self.conn.fileno())
+        except OSError:  # already closed
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        finally:
+            sock.detach()
+
+
+class Coordinator(Executor):
+    """Executor running calls on worker processes over multiprocessing sockets.
+
+    Workers connect to address with the shared authkey (generated unless
+    given): run_worker in processes of this or other hosts, or local ones
+    started by spawn. Every call is pickled and sent to an idle worker, one at
+    a time per worker, queued calls wait in submission order. A worker counts
+    as dead when its connection breaks or nothing, not even a heartbeat, came
+    from it for heartbeat_timeout seconds; its call is then sent to another
+    worker, so calls should be safe to repeat. After max_attempts lost
+    workers the future of a call fails with RuntimeError. Dead workers are
+    told to stop, and killed if spawn started them.
+    """
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        authkey=None,
+        heartbeat_timeout=5.0,
+        max_attempts=3,
+    ):
+        self.authkey = os.urandom(32) if authkey is None else authkey
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self._listener = Listener(address, authkey=self.authkey)
+        self.address = self._listener.address
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._calls = {}  # job: [future, blob, attempts]
+        self._workers = []
+        self._processes = []
+        self._jobs = itertools.count()
+        self._closed = threading.Event()
+        self.counters = {"completed": 0, "redispatched": 0, "lost_workers": 0}
+        for target in (self._accept, self._monitor):
+            threading.Thread(target=target, daemon=True).start()
+
+    def spawn(self, count=None, mp_context=None):
+        """Start count local worker processes (one per CPU by default).
+
+        They are started with the "spawn" method unless mp_context is given:
+        forking the threads of the coordinator can leave locks held forever.
+        """
+        mp_context = mp_context or multiprocessing.get_context("spawn")
+        processes = []
+        for _ in range(count or os.cpu_count() or 1):
+            process = mp_context.Process(
+                target=run_worker,
+                args=(self.address, self.authkey, self.heartbeat_timeout / 4),
+                daemon=True,
+            )
+            process.start()
+            processes.append(process)
+        self._processes.extend(processes)
+        return processes
+
+    def wait_for_workers(self, count, timeout=None):
+        """Block until count workers are connected; False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.stats()["workers"] < count:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def submit(self, fn, /, *args, **kwargs):
+        blob = pickle.dumps((fn, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        future = Future()
+        with self._lock:
+            if self._closed.is_set():
+                raise RuntimeError("cannot schedule new calls after shutdown")
+            job = next(self._jobs)
+            self._calls[job] = [future, blob, 0]
+            self._queue.append(job)
+            self._dispatch()
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            if cancel_futures:
+                while self._queue:
+                    self._calls.pop(self._queue.popleft())[0].cancel()
+            futures = [call[0] for call in self._calls.values()]
+        if wait:
+            concurrent.futures.wait(futures)
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.alive = False
+            worker.hang_up()
+        self._wake_accept()
+        self._listener.close()
+        for process in self._processes:
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "queued": len(self._queue),
+                "running": sum(worker.job is not None for worker in self._workers),
+                **self.counters,
+            }
+
+    def _wake_accept(self):
+        # a connection that never authenticates makes accept return
+        try:
+            if isinstance(self.address, tuple):
+                socket.create_connection(self.address, timeout=1.0).close()
+            else:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(self.address)
+        except (OSError, AttributeError):
+            pass
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue  # e.g. a client with a wrong authkey
+            if self._closed.is_set():
+                conn.close()
+                return
+            worker = _Worker(conn)
+            with self._lock:
+                self._workers.append(worker)
+                self._dispatch()
+            threading.Thread(target=self._read, args=(worker,), daemon=True).start()
+
+    def _read(self, worker):
+        while True:
+            try:
+                message = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                worker.seen = time.monotonic()
+                if message[0] == "result":
+                    self._finish(worker, *message[1:])
+                    self._dispatch()
+                elif message[0] == "hello":
+                    worker.pid = message[1]
+        with self._lock:
+            self._drop(worker)
+        worker.conn.close()
+
+    def _monitor(self):
+        while not self._closed.wait(self.heartbeat_timeout / 4):
+            now = time.monotonic()
+            with self._lock:
+                for worker in list(self._workers):
+                    if now - worker.seen > self.heartbeat_timeout:
+                        self._drop(worker)
+
+    def _finish(self, worker, job, ok, blob):
+        worker.job = None
+        call = self._calls.pop(job, None)
+        if call is None or call[0].done():
+            return
+        self.counters["completed"] += 1
+        try:
+            value = pickle.loads(blob)
+        except Exception as exception:
+            ok, value = False, exception
+        if ok:
+            call[0].set_result(value)
+        else:
+            call[0].set_exception(value)
+
+    def _drop(self, worker):
+        """Forget a dead worker and queue its call again; holds the lock."""
+        if not worker.alive:
+            return
+        worker.alive = False
+        self._workers.remove(worker)
+        worker.hang_up()  # the reading thread closes the connection
+        for process in self._processes:
+            if process.pid == worker.pid and process.is_alive():
+                process.kill()
+        if self._closed.is_set():
+            return
+        self.counters["lost_workers"] += 1
+        job, worker.job = worker.job, None
+        if job is not None and job in self._calls:
+            call = self._calls[job]
+            call[2] += 1
+            if call[2] >= self.max_attempts:
+                del self._calls[job]
+                call[0].set_exception(
+                    RuntimeError(f"Call lost with {call[2]} workers that died")
+                )
+            else:
+                self.counters["redispatched"] += 1
+                self._queue.appendleft(job)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Send queued calls to idle workers; holds the lock."""
+        for worker in list(self._workers):
+            while self._queue and worker.alive and worker.job is None:
+                job = self._queue.popleft()
+                future, blob, _ = self._calls[job]
+                if not future.running() and not future.set_running_or_notify_cancel():
+                    del self._calls[job]
+                    continue
+                worker.job = job
+                try:
+                    worker.conn.send(("call", job, blob))
+                except OSError:
+                    self._drop(worker)
+                    return
+
+
+class Event:
+    """Start or end of the execution of a Task, Workflow or WorkflowGraph.
+
+    timestamp comes from time.perf_counter_ns(); both events of one execution
+    share the span number.
+    """
+
+    __slots__ = (
+        "kind",
+        "obj",
+        "name",
+        "span",
+        "timestamp",
+        "thread_id",
+        "arg_size",
+        "exception",
+    )
+
+    def __init__(
+        self, kind, obj, name, span, timestamp, thread_id, arg_size=None, exception=None
+    ):
+        self.kind = kind
+        self.obj = obj
+        self.name = name
+        self.span = span
+        self.timestamp = timestamp
+        self.thread_id = thread_id
+        self.arg_size = arg_size
+        self.exception = exception
+
+
+class Instrumentation:
+    """Sends execution events to observers, objects with an on_event method.
+
+    While no observer is registered, calls only check the observers list.
+    Items run by a graph protocol are named after the key they run under, the
+    node key or "src->tar" for edges; other objects are named after their
+    function or class.
+    """
+
+    def __init__(self):
+        self.observers = []
+        self._spans = itertools.count()
+
+    def add(self, observer):
+        self.observers = [*self.observers, observer]
+        return observer
+
+    def remove(self, observer):
+        self.observers = [item for item in self.observers if item is not observer]
+
+    @contextmanager
+    def observe(self, *observers):
+        for observer in observers:
+            self.add(observer)
+        try:
+            yield observers[0] if len(observers) == 1 else observers
+        finally:
+            for observer in observers:
+                self.remove(observer)
+
+    def name_of(self, obj, key=None):
+        if key is not None:
+            return f"{key[0]}->{key[-1]}" if isinstance(key, tuple) else str(key)
+        if isinstance(obj, Task):
+            return getattr(obj.func, "__qualname__", type(obj.func).__name__)
+        return type(obj).__name__
+
+    def call(self, obj, context):
+        key = _item_key.get()
+        name = self.name_of(obj, key)
+        span = next(self._spans)
+        self._emit("start", obj, name, span, self._arg_size(obj, context))
+        # items nested in obj are not named after its key
+        token = None if key is None else _item_key.set(None)
+        try:
+            out = obj.protocol(obj, context)
+        except BaseException as exception:
+            self._emit("end", obj, name, span, exception=exception)
+            raise
+        finally:
+            if token is not None:
+                _item_key.reset(token)
+        if inspect.isawaitable(out):
+            return self._finish_awaitable(obj, name, span, out)
+        self._emit("end", obj, name, span)
+        return out
+
+    async def _finish_awaitable(self, obj, name, span, awaitable):
+        try:
+            out = await awaitable
+        except BaseException as exception:
+            self._emit("end", obj, name, span, exception=exception)
+            raise
+        self._emit("end", obj, name, span)
+        return out
+
+    def _emit(self, kind, obj, name, span, arg_size=None, exception=None):
+        event = Event(
+            kind,
+            obj,
+            name,
+            span,
+            time.perf_counter_ns(),
+            threading.get_ident(),
+            arg_size,
+            exception,
+        )
+        for observer in self.observers:
+            observer.on_event(event)
+
+    def _arg_size(self, obj, context):
+        if not isinstance(obj, Task):
+            return None
+        try:
+            args, kwargs = context.resolve_keys(obj.signature)
+        except Exception:
+            return None
+        return sum(sys.getsizeof(value) for value in (*args, *kwargs.values()))
+
+
+instrumentation = Instrumentation()
+
+_item_key = contextvars.ContextVar("grapy_item_key", default=None)
+
+
+def _call_item(key, obj, context):
+    """Run the graph item obj, reported to observers under its key."""
+    if not instrumentation.observers:
+        return obj(context)
+    token = _item_key.set(key)
+    try:
+        return obj(context)
+    finally:
+        _item_key.reset(token)
+
+
+class LatencyCollector:
+    """Aggregates durations per name into power of two histograms.
+
+    summary() reports durations in microseconds; percentiles are estimated as
+    the upper bound of the histogram bucket they fall into.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._starts = {}
+        self._stats = {}
+
+    def on_event(self, event):
+        with self._lock:
+            if event.kind == "start":
+                self._starts[event.span] = event.timestamp
+                return
+            started = self._starts.pop(event.span, None)
+            if started is None:
+                return
+            duration = event.timestamp - started
+            stats = self._stats.get(event.name)
+            if stats is None:
+                stats = self._stats[event.name] = {
+                    "count": 0,
+                    "errors": 0,
+                    "total": 0,
+                    "min": duration,
+                    "max": duration,
+                    "buckets": {},
+                }
+            stats["count"] += 1
+            stats["errors"] += event.exception is not None
+            stats["total"] += duration
+            stats["min"] = min(stats["min"], duration)
+            stats["max"] = max(stats["max"], duration)
+            bucket = duration.bit_length()
+            stats["buckets"][bucket] = stats["buckets"].get(bucket, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            return {name: self._summarize(stats) for name, stats in self._stats.items()}
+
+    def _summarize(self, stats):
+        histogram = {
+            (1 << bucket) / 1000: count
+            for bucket, count in sorted(stats["buckets"].items())
+        }
+        return {
+            "count": stats["count"],
+            "errors": stats["errors"],
+            "total_us": stats["total"] / 1000,
+            "mean_us": stats["total"] / stats["count"] / 1000,
+            "min_us": stats["min"] / 1000,
+            "max_us": stats["max"] / 1000,
+            "p50_us": self._percentile(histogram, stats["count"], 0.5),
+            "p90_us": self._percentile(histogram, stats["count"], 0.9),
+            "p99_us": self._percentile(histogram, stats["count"], 0.99),
+            "histogram_us": histogram,
+        }
+
+    def _percentile(self, histogram, count, fraction):
+        seen = 0
+        for upper_bound, bucket_count in histogram.items():
+            seen += bucket_count
+            if seen >= fraction * count:
+                return upper_bound
+
+
+class TraceCollector:
+    """Records executions as Chrome trace events (chrome://tracing, Perfetto)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._starts = {}
+        self.events = []
+
+    def on_event(self, event):
+        with self._lock:
+            if event.kind == "start":
+                self._starts[event.span] = event
+                return
+            start = self._starts.pop(event.span, None)
+            if start is None:
+                return
+            args = {"arg_size": start.arg_size}
+            if event.exception is not None:
+                args["exception"] = repr(event.exception)
+            self.events.append(
+                {
+                    "name": event.name,
+                    "cat": type(event.obj).__name__,
+                    "ph": "X",
+                    "ts": start.timestamp / 1000,
+                    "dur": (event.timestamp - start.timestamp) / 1000,
+                    "pid": os.getpid(),
+                    "tid": event.thread_id,
+                    "args": args,
+                }
+            )
+
+    def to_chrome_trace(self):
+        with self._lock:
+            return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def export(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_chrome_trace(), file)
+
+
+class SystemManager:
+    """Abstract class providing factory object for all classes"""
+
+    def __init__(self):
+        pass
+
+    def get_keygetter(self, *args, **kwargs):
+        return KeyGetter(*args, **kwargs)
+
+    def get_signature(self, *args, **kwargs):
+        return Signature(*args, **kwargs)
+
+    def get_context(self, *args, **kwargs):
+        return Context(*args, **kwargs)
+
+    def get_task(self, *args, **kwargs):
+        return Task(*args, **kwargs)
+
+    def get_workflow(self, *args, **kwargs):
+        return Workflow(*args, **kwargs)
+
+    def get_workflowgraph(self, *args, **kwargs):
+        return WorkflowGraph(*args, **kwargs)
+
+    def get_dataflowbuilder(self, *args, **kwargs):
+        return DataflowBuilder(*args, **kwargs)
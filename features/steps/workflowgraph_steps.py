@@ -47,7 +47,7 @@ def step_workflowgraph_diamond(context):
         root_node="node1",
         protocol=Protocols.WorkflowGraphProtocols.Balanced(),
     )
-    context.wfg_diamond = wfg
+    context.wfg = wfg
 
 
 @given("a sample context")
@@ -57,7 +57,11 @@ def step_sample_context(context):
 
 @when("the WorkflowGraph is executed")
 def step_workflowgraph_called(context):
-    context.result = context.wfg_diamond(context.sample_context)
+    context.error = None
+    try:
+        context.result = context.wfg(context.sample_context)
+    except ValueError as error:
+        context.error = error
 
 
 @then("the WorkflowGraph should return the expected result")
@@ -72,3 +76,82 @@ def step_impl(context):
     assert context.sample_context["edge2_2to3"] == 10
     assert context.sample_context["add3"] == 15
     assert context.sample_context["add3_1"] == 21
+
+
+def add(a, b):
+    return a + b
+
+
+def chain_graph(*node_keys):
+    return WorkflowGraph(
+        nodes={key: Task(add, Signature(1, 1), key) for key in node_keys},
+        edges={
+            (src, tar): Task(add, Signature(KeyGetter(src), 1), f"{src}->{tar}")
+            for src, tar in zip(node_keys, node_keys[1:])
+        },
+        root_node=node_keys[0],
+        protocol=Protocols.WorkflowGraphProtocols.Balanced(),
+    )
+
+
+@given("a WorkflowGraph")
+def step_workflowgraph(context):
+    context.wfg = WorkflowGraph(protocol=Protocols.WorkflowGraphProtocols.Balanced())
+    context.sample_context = Context()
+
+
+@given("nodes that form a loop")
+def step_nodes_loop(context):
+    loop = chain_graph("a", "b", "c", "a")
+    context.wfg.nodes = loop.nodes
+    context.wfg.edges = loop.edges
+    context.wfg.root_node = "a"
+
+
+@then("an error should be raised")
+def step_error_raised(context):
+    assert context.error is not None
+    assert "'a' -> 'b' -> 'c' -> 'a'" in str(context.error)
+
+
+@given("a WorkflowGraph with correctly connected nodes and edges")
+def step_workflowgraph_connected(context):
+    context.wfg = chain_graph("a", "b", "c")
+
+
+@given("a WorkflowGraph with incorrectly connected nodes and edges")
+def step_workflowgraph_disconnected(context):
+    context.wfg = chain_graph("a", "b", "c")
+    context.wfg.nodes["island"] = Task(add, Signature(1, 1), "island")
+    context.wfg.nodes["d"] = Task(add, Signature(1, 1), "d")
+    context.wfg.edges[("d", "c")] = Task(add, Signature(1, 1), "d->c")
+    context.disconnected = {"island", "d"}
+
+
+@given("a WorkflowGraph with correctly connected nodes and edges but missing node")
+def step_workflowgraph_missing_node(context):
+    context.wfg = chain_graph("a", "b", "c")
+    context.wfg.edges[("c", "d")] = Task(add, Signature(1, 1), "c->d")
+    context.disconnected = {"d"}
+
+
+@when("the connectivity is checked")
+def step_connectivity_checked(context):
+    context.report = context.wfg.validate()
+
+
+@then("the nodes and edges should be correctly connected")
+def step_correctly_connected(context):
+    assert context.report.connected
+    assert context.report.cycle is None
+
+
+@then("WorkflowGraph should return info about disconnected elements")
+def step_disconnected_elements(context):
+    report = context.report
+    assert not report.connected
+    assert context.disconnected == {
+        *report.unreachable,
+        *report.dangling_nodes,
+        *report.missing_nodes,
+    }
@@ -6,6 +6,27 @@ Feature: WorkflowGraph functionality
     When the WorkflowGraph is executed
     Then the WorkflowGraph should return the expected result
 
+  Scenario: WorkflowGraph copes with loops
+    Given a WorkflowGraph
+    And nodes that form a loop
+    When the WorkflowGraph is executed
+    Then an error should be raised
+
+  Scenario: WorkflowGraph checks connectivity - correct sample
+    Given a WorkflowGraph with correctly connected nodes and edges
+    When the connectivity is checked
+    Then the nodes and edges should be correctly connected
+
+  Scenario: WorkflowGraph checks connectivity - incorrect sample
+    Given a WorkflowGraph with incorrectly connected nodes and edges
+    When the connectivity is checked
+    Then WorkflowGraph should return info about disconnected elements
+
+  Scenario: WorkflowGraph checks connectivity - missing elements
+    Given a WorkflowGraph with correctly connected nodes and edges but missing node
+    When the connectivity is checked
+    Then WorkflowGraph should return info about disconnected elements
+
 
  #Feature: WorkflowGraph functionality
  #
@@ -38,27 +59,6 @@ Feature: WorkflowGraph functionality
  #    When the WorkflowGraph is traversed
  #    Then the nodes should be visited in the correct order
  #
- #  Scenario: WorkflowGraph copes with loops
- #    Given a WorkflowGraph
- #    And nodes that form a loop
- #    When the WorkflowGraph is executed
- #    Then an error should be raised
- #
- #  Scenario: WorkflowGraph checks connectivity - correct sample
- #    Given a WorkflowGraph with correctly connected nodes and edges
- #    When the connectivity is checked
- #    Then the nodes and edges should be correctly connected
- #
- #  Scenario: WorkflowGraph checks connectivity - incorrect sample
- #    Given a WorkflowGraph with incorrectly connected nodes and edges
- #    When the connectivity is checked
- #    Then WorkflowGraph should return info about disconnected elements
- #
- #  Scenario: WorkflowGraph checks connectivity - missing elements
- #    Given a WorkflowGraph with correctly connected nodes and edges but missing node
- #    When the connectivity is checked
- #    Then WorkflowGraph should return info about disconnected elements
- #
  #  Scenario: WorkflowGraph prints graph paths
  #    Given a WorkflowGraph
  #    And nodes and edges
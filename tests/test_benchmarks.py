@@ -0,0 +1,46 @@
+import sys
+import os
+
+sys.path.append("..")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+import pytest
+from grapy.classes import Context, Protocols
+from grapy.benchmarks.bench import SHAPES, PROTOCOLS, compare, measure, run_suite
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+def test_shapes_run_with_balanced(shape):
+    graph = SHAPES[shape](20, Protocols.WorkflowGraphProtocols.Balanced())
+    assert len(graph.nodes) == 20
+    plan = graph.compile()
+    # every node is executed exactly once
+    assert len(plan) == len(graph.nodes) + len(graph.edges)
+    ctx = Context()
+    graph(ctx)
+    assert ctx["n19"] == 19
+
+
+def test_measure_reports_percentiles():
+    result = measure("noop", lambda: None, items=10, repeat=5, min_time=0)
+    assert result["runs"] >= 5
+    assert result["p50_s"] <= result["p90_s"] <= result["p99_s"]
+    assert result["peak_bytes"] >= 0
+
+
+def test_run_suite_and_compare():
+    results = run_suite(
+        ["chain"], [5], list(PROTOCOLS), repeat=2, min_time=0, micro=False
+    )
+    assert [result["name"] for result in results["results"]] == [
+        f"graph/{name}/chain/5" for name in PROTOCOLS
+    ]
+    slower = {
+        "results": [
+            dict(result, p50_s=result["p50_s"] * 2) for result in results["results"]
+        ]
+    }
+    rows = compare(results, slower)
+    assert len(rows) == len(PROTOCOLS)
+    assert all(row[-1] for row in rows)
+    assert not any(row[-1] for row in compare(results, results))